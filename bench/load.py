@@ -0,0 +1,260 @@
+#!/bin/python3
+
+# Load test for a bot's request handler. Runs the handler in this process
+# against a throwaway store, a stand-in Slack webhook and a stand-in sign,
+# fires a mix of slash commands at increasing concurrency and store sizes,
+# and reports latency, throughput, and the cost of save() and of one
+# announcement pass. Each run is appended to a results file and compared
+# with the previous run for the same bot and store.
+#
+#     python bench/load.py --sizes 100,1000,10000 --concurrency 1,8,32
+#     python bench/load.py --bot birthbot --mix set=1,when=4,upcoming=1
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import threading
+import contextlib
+import subprocess
+import http.client
+import http.server
+import urllib.parse
+import concurrent.futures
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), ROOT]
+import sign
+import verify
+import startup
+
+SECRET = "bench"
+
+MIXES = {
+    "deadbot": "set=4,who=4,upcoming=2,add=1",
+    "birthbot": "set=2,when=4,upcoming=2",
+}
+
+class StubSlackHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    posts = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"] or 0))
+        type(self).posts += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+def stub(handler):
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(httpd.server_address[1])
+
+def write_secrets(path, hook):
+    for name in ["_secret.py", "_secret_birthbot.py"]:
+        with open(os.path.join(path, name), "w") as fd:
+            fd.write("HOOK = {!r}\nSIGNING_SECRET = {!r}\n".format(hook, SECRET))
+
+def parse_mix(s):
+    mix = {}
+    for part in s.split(","):
+        name, _, weight = part.partition("=")
+        mix[name] = int(weight or 1)
+    return mix
+
+def command(bot, name, n, counter):
+    i = random.randrange(n)
+    if bot == "deadbot":
+        if name == "add":
+            return "add LOAD{} 2040-01-01 12:00".format(next(counter))
+        if name == "upcoming":
+            return "upcoming"
+        return "{} CONF{}".format(name, i)
+    else:
+        if name == "set":
+            return "<@U{}> set 1990-{:02}-{:02}".format(i, random.randrange(1, 13), random.randrange(1, 29))
+        if name == "when":
+            return "when <@U{}>".format(i)
+        return name
+
+TRIGGERS = itertools.count()
+
+def post(port, slash, text):
+    # Slack sends a fresh trigger_id with each command, so no two bodies match
+    body = urllib.parse.urlencode({"command": slash, "user_id": "U1", "text": text, "trigger_id": next(TRIGGERS)}).encode("utf-8")
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        start = time.perf_counter()
+        headers = dict(verify.sign(SECRET, int(time.time()), body), **{"Content-Type": "application/x-www-form-urlencoded"})
+        conn.request("POST", "/", body=body, headers=headers)
+        res = conn.getresponse()
+        reply = res.read()
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.close()
+    # Errors raised by a command come back as "*KeyError*: ..."
+    return elapsed, res.status == 200 and not json.loads(reply).get("text", "").startswith("*")
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as fd, contextlib.redirect_stdout(fd), contextlib.redirect_stderr(fd):
+        yield
+
+def percentile(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+def load(port, slash, texts, concurrency):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda text: post(port, slash, text), texts))
+    wall = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    return {
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput": len(texts) / wall,
+        "errors": sum(not ok for _, ok in results),
+    }
+
+def timed(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+def open_store(mod, bot, backend, sign_url):
+    mod.BOT.configure(argparse.Namespace(store=backend, sign=sign_url, publish=False))
+    if bot == "deadbot":
+        data = mod.TENANTS[None].data
+    else:
+        data = mod.DATA = mod.BOT.data = (mod.SqliteBirthdays if backend == "sqlite" else mod.Birthdays)()
+    if backend == "sqlite":
+        old = (mod.Deadlines if bot == "deadbot" else mod.Birthdays)()
+        old.load()
+        data.db.create()
+        data.migrate(old)
+    mod.BOT.startup()
+    return data
+
+def stored_bytes(data):
+    path = data.db.path if hasattr(data, "db") else data.journal.snapshot
+    return os.path.getsize(path)
+
+def announcement_pass(mod, bot, data):
+    if bot == "deadbot":
+        with data.read():
+            keys = [(None, name, conf.when) for name, conf in data.upcoming(datetime.utcnow())]
+        mod.make_announcements(keys)
+    else:
+        with data.read():
+            names = [name for name, _ in data.all()]
+        mod.make_announcements(names)
+
+def commit():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(result, path):
+    previous = None
+    if os.path.exists(path):
+        with open(path) as fd:
+            for line in fd:
+                entry = json.loads(line)
+                if entry["bot"] == result["bot"] and entry["store"] == result["store"]:
+                    previous = entry
+    if not previous: return
+    before = {(r["size"], r["concurrency"]): r for r in previous["runs"]}
+    runs = [(r, before[r["size"], r["concurrency"]]) for r in result["runs"] if (r["size"], r["concurrency"]) in before]
+    if runs:
+        print("\nCompared with {} ({}):".format(previous["commit"], previous["time"]))
+    for r, old in runs:
+        print("  size {:>6} x{:<3} p99 {:+6.0%}  throughput {:+6.0%}".format(
+            r["size"], r["concurrency"], r["p99_ms"] / old["p99_ms"] - 1, r["throughput"] / old["throughput"] - 1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bot", choices=["deadbot", "birthbot"], default="deadbot")
+    parser.add_argument("--store", choices=["pickle", "sqlite"], default="pickle")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Conferences (or people) in the store")
+    parser.add_argument("--history", type=int, default=5, help="Past occurrences per conference")
+    parser.add_argument("--concurrency", default="1,8,32", help="Requests in flight at once")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per concurrency level")
+    parser.add_argument("--mix", help="Weighted commands, e.g. " + MIXES["deadbot"])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--saves", type=int, default=5, help="Times to repeat save()")
+    parser.add_argument("--results", default=os.path.join(ROOT, "bench", "load-results.jsonl"))
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix or MIXES[args.bot])
+    names = [name for name, weight in mix.items() for _ in range(weight)]
+    hook = stub(StubSlackHandler) + "/hook"
+    sign_url = stub(type("QuietSign", (sign.StubSignHandler,), {"log_message": lambda self, *args: None}))
+
+    result = {"bot": args.bot, "store": args.store, "mix": mix, "commit": commit(),
+              "time": datetime.now().isoformat(timespec="seconds"), "runs": [], "save": [], "announce": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        write_secrets(tmp, hook)
+        sys.path[:0] = [tmp, ROOT]
+        import bot
+        import server
+        mod = __import__(args.bot)
+        bot.SLACK.interval = 0
+        handler = type("QuietHandler", (bot.RequestHandler.serving(mod.BOT),), {"log_message": lambda self, *args: None})
+
+        for size in map(int, args.sizes.split(",")):
+            path = os.path.join(tmp, str(size))
+            os.makedirs(path)
+            os.chdir(path)
+            random.seed(size)
+            with quiet():
+                startup.write_store(path, args.bot, size, args.history)
+                data = open_store(mod, args.bot, args.store, sign_url)
+            httpd = server.listen(handler, 0, args.workers)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            port = httpd.server_address[1]
+            counter = iter(range(10 ** 9))
+
+            print("{} with {} {}:".format(args.bot, size, "conferences" if args.bot == "deadbot" else "people"))
+            try:
+                for concurrency in map(int, args.concurrency.split(",")):
+                    texts = [command(args.bot, random.choice(names), size, counter) for _ in range(args.requests)]
+                    with quiet():
+                        run = dict(size=size, concurrency=concurrency, **load(port, mod.BOT.slash, texts, concurrency))
+                    result["runs"].append(run)
+                    print("  x{:<3} p50 {:7.2f} ms  p99 {:7.2f} ms  {:7.0f} req/s  {} errors".format(
+                        concurrency, run["p50_ms"], run["p99_ms"], run["throughput"], run["errors"]))
+
+                with data.lock():
+                    save_ms = timed(data.save, args.saves)
+                result["save"].append({"size": size, "ms": save_ms, "bytes": stored_bytes(data)})
+                posts = StubSlackHandler.posts
+                with quiet():
+                    announce_ms = timed(lambda: announcement_pass(mod, args.bot, data), 1)
+                    bot.SLACK.drain()
+                result["announce"].append({"size": size, "ms": announce_ms, "posts": StubSlackHandler.posts - posts})
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+            print("  save() {:.1f} ms for {:.1f} MB, announcement pass {:.1f} ms".format(
+                save_ms, result["save"][-1]["bytes"] / 1e6, announce_ms))
+        os.chdir(ROOT)
+
+    compare(result, args.results)
+    with open(args.results, "a") as fd:
+        fd.write(json.dumps(result) + "\n")
+    print("\nSaved to", args.results)
@@ -0,0 +1,96 @@
+#!/bin/python3
+
+# Measures how long a freshly started bot takes to accept a connection and
+# to answer its first slash command, with and without --fast-start.
+#
+#     python bench/startup.py --conferences 20000 --history 20
+
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "bench"
+
+def write_secrets(path):
+    for name in ["_secret.py", "_secret_birthbot.py"]:
+        with open(os.path.join(path, name), "w") as fd:
+            fd.write("HOOK = 'http://127.0.0.1:9/'\nTOKEN = {!r}\n".format(TOKEN))
+
+def write_store(path, bot, n, history):
+    sys.path[:0] = [path, ROOT]
+    random.seed(0)
+    now = datetime.utcnow()
+    if bot == "deadbot":
+        import deadbot
+        state = {
+            "CONF{}".format(i): [
+                deadbot.Conference(now + timedelta(days=365 * (year - history + 1) + random.randrange(365)),
+                                   {"U{}".format(random.randrange(200)) for _ in range(3)},
+                                   [28, 21, 14, 7])
+                for year in range(history)]
+            for i in range(n)}
+        fn = "data.pickle"
+    else:
+        import birthbot
+        state = {"U{}".format(i): birthbot.Birthday(birthbot.date(1990, 1, 1) + timedelta(days=random.randrange(365)), [])
+                 for i in range(n)}
+        fn = "birthbot.pickle"
+    with open(os.path.join(path, fn), "wb") as fd:
+        pickle.dump(state, fd)
+    return os.path.getsize(os.path.join(path, fn))
+
+def post(port, text):
+    body = urllib.parse.urlencode({"token": TOKEN, "user_id": "U1", "text": text}).encode("utf-8")
+    with urllib.request.urlopen(urllib.request.Request("http://127.0.0.1:{}/".format(port), data=body, method="POST"), timeout=60) as res:
+        return json.loads(res.read())
+
+def run(path, bot, port, flags):
+    env = dict(os.environ, PYTHONPATH=path)
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, bot + ".py"), "--port", str(port)] + flags,
+                            cwd=path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if proc.poll() is not None: raise RuntimeError("{} exited during startup".format(bot))
+                time.sleep(0.001)
+        bound = time.perf_counter() - start
+        post(port, "upcoming")
+        answered = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+    return bound, answered
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bot", choices=["deadbot", "birthbot"], default="deadbot")
+    parser.add_argument("--conferences", type=int, default=5000, help="Conferences (or people) in the store")
+    parser.add_argument("--history", type=int, default=10, help="Past occurrences per conference")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=58123)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        write_secrets(path)
+        size = write_store(path, args.bot, args.conferences, args.history)
+        print("{}: {:.1f} MB store".format(args.bot, size / 1e6))
+        for name, flags in [("eager", []), ("fast-start", ["--fast-start"])]:
+            results = [run(path, args.bot, args.port, flags) for _ in range(args.runs)]
+            bound = sorted(r[0] for r in results)[len(results) // 2]
+            answered = sorted(r[1] for r in results)[len(results) // 2]
+            print("{:>10}: port open after {:6.1f} ms, first reply after {:6.1f} ms".format(name, bound * 1000, answered * 1000))
@@ -1,143 +1,248 @@
 #!/bin/python3
 
 import math
-import urllib.request
-import http.server
-import json
+import bisect
 import codecs
-import shlex
-import argparse
+import calendar
 import datetime
+import itertools
 import collections
-import pickle
 import os
-import threading
 import contextlib
 
+import bot
+import server
+import store
+from bot import Ephemeral, Response, parse_uid
+
 date = datetime.date
-from _secret_birthbot import HOOK, TOKEN
+import _secret_birthbot
+from _secret_birthbot import HOOK
+TOKEN = getattr(_secret_birthbot, "TOKEN", None)
+SIGNING_SECRET = getattr(_secret_birthbot, "SIGNING_SECRET", None)
+FEED_TOKEN = getattr(_secret_birthbot, "FEED_TOKEN", None)
 
 def to_slack(msg : str):
-    req = urllib.request.Request(HOOK, data=json.dumps({"text": msg}).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=15) as res:
-        if res.getcode() == 200:
-            return
-        else:
-            raise IOError("Scary reponse from Slack", res)
-
-class BirthdayRequestHandler(http.server.BaseHTTPRequestHandler):
-    def do_POST(self):
-        length = int(self.headers["Content-Length"])
-        data = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
-
-        if data["token"] != [TOKEN]:
-            self.send_response(400)
-            self.end_headers()
-            return
-
-        self.send_response(200)
-
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-
-        uid = data["user_id"][0]
-        args = ns(shlex.split(data["text"][0]))
-
-        with DATA.lock():
-            try:
-                response = handle(uid, args)
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                response = Ephemeral("*{}*: {}".format(type(e).__name__, e))
-        assert DATA.unlocked()
-
-        if response:
-            self.wfile.write(json.dumps({
-                "response_type": "in_channel" if isinstance(response, Response) else "ephemeral",
-                "text": str(response)
-            }).encode("utf-8"))
-        else:
-            self.wfile.write(json.dumps({"response_type": "in_channel"}).encode("utf-8"))
-
-def start_server(port:int = 57001):
-    httpd = http.server.HTTPServer(("", port), BirthdayRequestHandler)
-    httpd.serve_forever()
-
-class Ephemeral(str): pass
-class Response(str): pass
-
-class ns:
-    def __init__(self, args):
-        self.args = args
-
-    def match(self, *pat):
-        out = []
-        if len(pat) != len(self.args):
-            return False
-        for val, arg in zip(pat, self.args):
-            if isinstance(val, list):
-                out.append(arg)
-            elif val == arg:
-                continue
-            else:
-                return False
-        self.vars = out
-        return True
+    bot.SLACK.put(msg, HOOK)
 
+# Birthdays as returned by SQLite, and pickled before Entry
 Birthday = collections.namedtuple("Birthday", ["when", "announcements"])
 
-class Birthdays:
-    def __init__(self):
-        self.birthdays = None
-        self._birthdays = {}
-        self._lock = threading.Lock()
-
-    @contextlib.contextmanager
-    def lock(self):
-        self._lock.acquire()
-        self.birthdays = self._birthdays
-        yield
-        self._birthdays = self.birthdays
-        self.birthdays = None
-        self._lock.release()
-
-    def unlocked(self):
-        return not self.birthdays
-
-    def save(self):
-        with open("birthbot.pickle", "wb") as fd:
-            pickle.dump(self.birthdays, fd)
-
-    def load(self):
-        if os.path.exists("birthbot.pickle"):
-            with open("birthbot.pickle", "rb") as fd:
-                self.birthdays = pickle.load(fd)
-                print("Loaded birthdays of {} people".format(len(self.birthdays)))
+# A birthday in memory, remembering only the last day it was announced
+class Entry:
+    __slots__ = ("when", "announced")
+
+    def __init__(self, when, announced=None):
+        self.when = when
+        self.announced = announced
+
+    @property
+    def announcements(self):
+        return [self.announced] if self.announced else []
+
+    def __reduce__(self):
+        return (Entry, (self.when, self.announced))
+
+# Feb 29 birthdays are celebrated on Feb 28 in common years
+def observed(born, year):
+    if (born.month, born.day) == (2, 29) and not calendar.isleap(year):
+        return date(year, 2, 28)
+    return born.replace(year=year)
+
+def celebrated(day):
+    """The (month, day) birthdays celebrated on `day`"""
+    if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+        return [(2, 28), (2, 29)]
+    return [(day.month, day.day)]
+
+# Birthdays are also indexed by (month, day), with the days that have any
+# birthdays kept sorted, so finding today's birthdays or the next few does
+# not depend on how many people there are.
+class Birthdays(store.Store):
+    def __init__(self, root="."):
+        super().__init__(os.path.join(root, "birthbot.pickle"), os.path.join(root, "birthbot.journal"))
+        self.birthdays = {}
+        self.days = {}
+        self.keys = []
+
+    def snapshot(self):
+        return self.birthdays
+
+    def restore(self, birthdays):
+        self.birthdays = {name: bday if isinstance(bday, Entry) else Entry(bday.when, max(bday.announcements, default=None))
+                          for name, bday in birthdays.items()}
+        self.days = {}
+        for name, bday in self.birthdays.items():
+            self.days.setdefault((bday.when.month, bday.when.day), set()).add(name)
+        self.keys = sorted(self.days)
+
+    def size(self):
+        return len(self.birthdays)
+
+    def summary(self):
+        return "birthdays of {} people".format(self.size())
+
+    # Only today's announcement can still stop a repeat
+    def expire(self):
+        today = date.today()
+        expired = False
+        for bday in self.birthdays.values():
+            if bday.announced and bday.announced < today:
+                bday.announced = None
+                expired = True
+        return expired
+
+    def apply(self, op, name, *args):
+        if op == "set":
+            if name in self.birthdays:
+                self.unindex(name)
+            self.birthdays[name] = Entry(*args)
+            self.index(name)
+        elif op == "delete":
+            self.unindex(name)
+            del self.birthdays[name]
+        elif op == "announce":
+            bday = self.birthdays[name]
+            bday.announced = max(bday.announced or args[0], args[0])
+        else:
+            raise ValueError("Unknown journal record {}".format(op))
+
+    def index(self, name):
+        when = self.birthdays[name].when
+        key = (when.month, when.day)
+        if key not in self.days:
+            self.days[key] = set()
+            bisect.insort(self.keys, key)
+        self.days[key].add(name)
+
+    def unindex(self, name):
+        when = self.birthdays[name].when
+        key = (when.month, when.day)
+        self.days[key].discard(name)
+        if not self.days[key]:
+            del self.days[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
 
     def get(self, name):
         return self.birthdays[name]
 
+    def on(self, day):
+        """Names whose birthday is celebrated on `day`"""
+        return set().union(*[self.days.get(key, ()) for key in celebrated(day)])
+
     def set(self, name, date):
-        self.birthdays[name] = Birthday(date, [])
+        self.commit("set", name, date)
 
     def delete(self, name):
-        del self.birthdays[name]
+        self.commit("delete", name)
+
+    def announced(self, name, date):
+        self.commit("announce", name, date)
 
     @staticmethod
     def next(bday, when):
-        next = bday.when.replace(year=when.year)
+        next = observed(bday.when, when.year)
         if next < when or next == when and when in bday.announcements:
-            next = next.replace(year=next.year + 1)
+            next = observed(bday.when, when.year + 1)
         return next
 
-    def upcoming(self, when):
-        out = [(user, Birthdays.next(bday, when)) for user, bday in self.birthdays.items()]
-        return sorted(out, key=lambda x: x[1])
+    # Walks the days from `when` round to the day before it; anyone already
+    # announced on `when` comes last, a year away
+    def upcoming(self, when, limit=None):
+        out, last = [], []
+        today = celebrated(when)
+        start = bisect.bisect_left(self.keys, (when.month, when.day))
+        for key in itertools.chain(self.keys[start:], self.keys[:start]):
+            if limit is not None and len(out) >= limit: break
+            for user in sorted(self.days[key]):
+                bday = self.birthdays[user]
+                (last if key in today and when in bday.announcements else out).append((user, Birthdays.next(bday, when)))
+        return (out + last)[:limit]
 
     def all(self):
         return sorted(self.birthdays.items())
 
+BIRTHDAYS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS birthdays (
+    name TEXT PRIMARY KEY,
+    "when" TEXT NOT NULL,
+    day TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS birthdays_day ON birthdays (day);
+CREATE TABLE IF NOT EXISTS birthday_announcements (
+    name TEXT NOT NULL REFERENCES birthdays (name) ON DELETE CASCADE,
+    "date" TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS birthday_announcements_name ON birthday_announcements (name, "date");
+"""
+
+class SqliteBirthdays(store.SqliteStore, Birthdays):
+    def __init__(self, root="."):
+        super().__init__(root)
+        self.db = store.Database(os.path.join(root, "birthbot.sqlite"), BIRTHDAYS_SCHEMA)
+
+    def size(self):
+        n, = self.db.execute("SELECT COUNT(*) FROM birthdays").fetchone()
+        return n
+
+    def expire(self):
+        with self.db.transaction():
+            self.db.execute('DELETE FROM birthday_announcements WHERE "date" < ?', (date.today().isoformat(),))
+        return False
+
+    def apply(self, op, name, *args):
+        if op == "set":
+            when, = args
+            self.db.execute("DELETE FROM birthdays WHERE name = ?", (name,))
+            self.db.execute("INSERT INTO birthdays VALUES (?, ?, ?)", (name, when.isoformat(), "{:%m-%d}".format(when)))
+        elif op == "delete":
+            if not self.db.execute("DELETE FROM birthdays WHERE name = ?", (name,)).rowcount:
+                raise KeyError(name)
+        elif op == "announce":
+            self.get(name)
+            self.db.execute("INSERT INTO birthday_announcements VALUES (?, ?)", (name, args[0].isoformat()))
+        else:
+            raise ValueError("Unknown journal record {}".format(op))
+
+    def rows(self, rows):
+        rows = list(rows)
+        announcements = collections.defaultdict(list)
+        names = [name for name, _ in rows]
+        for name, d in self.db.execute('SELECT name, "date" FROM birthday_announcements WHERE name IN ({}) ORDER BY rowid'.format(",".join("?" * len(names))), names):
+            announcements[name].append(date.fromisoformat(d))
+        return [(name, Birthday(date.fromisoformat(when), announcements[name])) for name, when in rows]
+
+    def get(self, name):
+        rows = self.rows(self.db.execute('SELECT name, "when" FROM birthdays WHERE name = ?', (name,)))
+        if not rows: raise KeyError(name)
+        return rows[0][1]
+
+    def on(self, day):
+        days = ["{:02}-{:02}".format(*key) for key in celebrated(day)]
+        return {name for name, in self.db.execute("SELECT name FROM birthdays WHERE day IN ({})".format(",".join("?" * len(days))), days)}
+
+    def upcoming(self, when, limit=None):
+        # Later this year, then next year, with anyone already announced today last
+        rows = self.db.execute("""
+            SELECT name, "when" FROM (
+                SELECT name, "when", day, CASE WHEN day = '02-29' AND NOT :leap THEN '02-28' ELSE day END AS observed FROM birthdays)
+            ORDER BY
+                CASE WHEN observed > :day THEN 1 WHEN observed < :day THEN 2
+                     WHEN name IN (SELECT name FROM birthday_announcements WHERE "date" = :date) THEN 3
+                     ELSE 0 END, observed, day, name
+            LIMIT :limit""", {"day": "{:%m-%d}".format(when), "date": when.isoformat(),
+                                 "leap": calendar.isleap(when.year), "limit": -1 if limit is None else limit})
+        return [(user, Birthdays.next(bday, when)) for user, bday in self.rows(rows)]
+
+    def all(self):
+        return self.rows(self.db.execute('SELECT name, "when" FROM birthdays ORDER BY name'))
+
+    def migrate(self, birthdays):
+        with self.db.transaction():
+            for name, bday in birthdays.all():
+                self.apply("set", name, bday.when)
+                self.db.executemany("INSERT INTO birthday_announcements VALUES (?, ?)", [(name, d.isoformat()) for d in bday.announcements])
+
 DATA = Birthdays()
 
 def describe_who(who):
@@ -147,41 +252,82 @@ def describe_who(who):
         names = "No one"
     return names
 
-def parse_uid(user):
-    assert user[0] == "<"
-    assert user[-1] == ">"
-    assert user[1] == "@"
-    return user[2:-1].split("|")[0]
+class Birthbot(bot.Bot):
+    def configure(self, args):
+        global DATA
+        if args.store == "sqlite":
+            DATA = self.data = SqliteBirthdays()
+
+    def secrets(self):
+        return [SIGNING_SECRET] if SIGNING_SECRET else []
+
+    def unsigned(self):
+        return not SIGNING_SECRET
 
-COMMANDS = []
+    def authorize(self, data, secret):
+        if SIGNING_SECRET:
+            authorized = secret == SIGNING_SECRET
+        else:
+            authorized = data.get("token") == [TOKEN]
+        if authorized:
+            return contextlib.nullcontext()
+
+    # GET /birthday.ics?token=FEED_TOKEN
+    def feed(self, query):
+        if bot.feed_token(query, FEED_TOKEN):
+            return "Birthdays", DATA, birthday_events
+
+    def startup(self):
+        with DATA.lock():
+            DATA.load()
+            if DATA.dirty() or DATA.expire():
+                DATA.save()
+        start_announcements()
+
+    def announce(self, keys):
+        make_announcements(keys)
+
+    def shutdown(self):
+        if DATA.loaded.is_set():
+            with DATA.lock():
+                DATA.save()
+        return DATA.loaded.is_set()
+
+BOT = Birthbot("/birthday", DATA)
+COMMANDS = BOT.commands
+command = BOT.command
+BirthdayRequestHandler = bot.RequestHandler.serving(BOT)
 
 def handle(uid, args):
-    for pattern, opts, f in COMMANDS:
-        if args.match(*pattern):
-            print(" ".join(args.args), "(executing in {})".format(f.__name__))
-            if opts["uid"]:
-                return f(uid, *args.vars)
-            else:
-                return f(*args.vars)
-    else:
-        return Ephemeral("I couldn't understand that command\n\n" + help())
+    return BOT.handle(uid, args)
 
-def command(*pattern, uid=False, public=False):
-    def decorator(f):
-        COMMANDS.append((pattern, { "uid": uid, "public": public }, f))
-        return f
-    return decorator
+def start_server(port:int = 57001, workers:int = 8):
+    server.serve(BirthdayRequestHandler, port, workers)
 
-def new_announcements():
+def new_announcements(due):
     now = date.today()
     out = []
-    for name, bday in DATA.all():
-        inst = bday.when.replace(year=now.year)
-        if inst != now or inst in bday.announcements: continue
-        bday.announcements.append(inst)
+    today = DATA.on(now)
+    for name in due:
+        if name not in today: continue
+        if now in DATA.get(name).announcements: continue
+        DATA.announced(name, now)
         out.append(name)
     return out
 
+def schedule(name):
+    try:
+        due = Birthdays.next(DATA.get(name), date.today())
+    except KeyError:
+        due = None
+    if due:
+        BOT.schedule(name, datetime.datetime.combine(due, datetime.time()).timestamp())
+    else:
+        BOT.cancel(name)
+
+def reschedule(op, name, *args):
+    schedule(name)
+
 def days_ago(d):
     n = round((d - date.today()) / datetime.timedelta(days=1))
     return ("1 day" if n == 1 else "{} days".format(n))
@@ -189,27 +335,18 @@ def days_ago(d):
 def print_date(date):
     return "{:%d %b} ({})".format(date, days_ago(date))
 
-def make_announcements():
-    who = new_announcements()
+def make_announcements(due):
+    with DATA.lock():
+        who = new_announcements(due)
     if who:
         print("Announcing birthdays for", who)
         to_slack("Happy birthday {}!".format(describe_who(who)))
 
-def start_announcement_thread():
-    with DATA.lock():
-        try:
-            make_announcements()
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-        DATA.save()
-
-    assert DATA.unlocked()
-
-    FREQUENCY = 60 * 60
-    timer = threading.Timer(FREQUENCY, start_announcement_thread)
-    timer.start()
-    return timer
+def start_announcements():
+    with DATA.read():
+        for name, bday in DATA.all():
+            schedule(name)
+    DATA.watchers.append(reschedule)
 
 def parse_date(s):
     fmts = ["%Y-%m-%d", "%m/%d", "%m-%d", "%m/%d/%Y", "%m/%d/%y"]
@@ -247,61 +384,42 @@ class Commands:
         """Delete your birthday from the database"""
         return DATA.delete(uid)
 
-    @command("when", ["user"])
+    @command("when", ["user"], lock="read")
     def when(user):
         """When is someone's birthday?"""
         uid = parse_uid(user)
         when = Birthdays.next(DATA.get(uid), date.today())
         return Ephemeral("<@{}>'s next birthday is on {}".format(uid, print_date(when)))
 
-    @command("upcoming")
+    @command("upcoming", lock="read", defer=True)
     def upcoming():
         """List upcoming birthdays"""
-        upcoming = DATA.upcoming(date.today())
-        return Ephemeral("The following birthdays are coming up:\n" + "\n".join([
-            "• <@{}> on {}".format(name, print_date(when))
-            for name, when in upcoming]))
+        today = date.today()
+        return Ephemeral(DATA.cached("upcoming", today, lambda: render_upcoming(today)))
 
-    @command("help")
+    @command("help", lock=None)
     def help():
         return Ephemeral(help())
 
-FORMATS = {
-    "user": "@USER",
-    "date": "YYYY-MM-DD",
-    "time": "HH:MM",
-}
+# Yearly from 2000, a leap year, so birth years stay private; Feb 29
+# birthdays fall on the last day of February
+def birthday_events():
+    return [("{}@birthbot".format(name), "{}'s birthday".format(name), observed(bday.when, 2000),
+             "FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=-1" if (bday.when.month, bday.when.day) == (2, 29) else "FREQ=YEARLY")
+            for name, bday in DATA.all()]
+
+# Good until the day changes
+def render_upcoming(today):
+    upcoming = DATA.upcoming(today)
+    text = "The following birthdays are coming up:\n" + "\n".join([
+        "• <@{}> on {}".format(name, print_date(when))
+        for name, when in upcoming])
+    return text, today + datetime.timedelta(days=1)
 
 def help():
-    private = "I understand the following commands:\n\n"
-    public = "Public announcement commands:\n\n"
-    for pattern, opts, f in COMMANDS:
-        if not f.__doc__: continue
-        s = "• `/birthday "
-        for val in pattern:
-            if isinstance(val, list):
-                s += FORMATS.get(val[0], val[0].upper())
-            else:
-                s += val
-            s += " "
-        s += "` — " + str(f.__doc__) + "\n"
-        if opts["public"]:
-            public += s
-        else:
-            private += s
-    return private + "\n" + public
+    return BOT.help()
 
+# Run through the module, so what it pickles names birthbot and not __main__
 if __name__ == "__main__":
-    with DATA.lock():
-        DATA.load()
-    assert DATA.unlocked()
-
-    try:
-        announce_thread = start_announcement_thread()
-        try:
-            start_server()
-        except KeyboardInterrupt:
-            announce_thread.cancel()
-    finally:
-        with DATA.lock():
-            DATA.save()
+    import birthbot
+    bot.main([birthbot.BOT], port=57001)
@@ -0,0 +1,459 @@
+import sys
+import hmac
+import time
+import json
+import shlex
+import argparse
+import datetime
+import threading
+import traceback
+import contextlib
+import email.utils
+import collections
+import urllib.parse
+import http.client
+import http.server
+import concurrent.futures
+
+import server
+import verify
+import calendars
+import metrics
+import dispatch
+import delivery
+import scheduler
+
+# What the bots share when they run in one process: one HTTP server, one
+# Slack outbox and one scheduler. Each bot owns a slash command, and a
+# request goes to the bot named by the `command` field Slack sends.
+
+SLACK = delivery.Outbox()
+
+class Ephemeral(str): pass
+class Response(str): pass
+
+def parse_uid(user):
+    assert user[0] == "<"
+    assert user[-1] == ">"
+    assert user[1] == "@"
+    return user[2:-1].split("|")[0]
+
+BOTS = {}
+
+# Scheduler keys are (slash, key) so each bot gets back only its own keys;
+# COMPACT is the one key that belongs to no bot
+def fire(due):
+    by_bot = collections.defaultdict(list)
+    for slash, key in due:
+        by_bot[slash].append(key)
+    for slash, keys in by_bot.items():
+        try:
+            if slash is None:
+                compact()
+            else:
+                BOTS[slash].announce(keys)
+        except Exception:
+            traceback.print_exc()
+
+# Stores otherwise only expire what no longer matters when they are saved,
+# which a quiet bot does at startup and shutdown, so each day every store
+# expires and snapshots on schedule
+COMPACT = (None, "compact")
+COMPACT_INTERVAL = 24 * 60 * 60
+
+def compact():
+    SCHEDULER.schedule(COMPACT, time.time() + COMPACT_INTERVAL)
+    for bot in BOTS.values():
+        try:
+            bot.compact()
+        except Exception:
+            traceback.print_exc()
+
+SCHEDULER = scheduler.Scheduler(fire)
+
+# Commands registered with defer=True are acknowledged at once and answered
+# later through the request's response_url, so a slow command cannot miss
+# Slack's three second deadline.
+DEFERRED = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="deferred")
+
+# With --fast-start, requests wait this long for a store still loading, and
+# give up at once if loading failed, so no worker outlives the server
+LOAD_WAIT = 10
+FAILED = threading.Event()
+
+REJECTED = metrics.Counter("deadbot_rejected_requests_total", "Requests refused before reaching a bot", ("reason",))
+FORWARDED = metrics.Counter("deadbot_forwarded_requests_total", "Requests a follower passed to the leader, by response status", ("status",))
+FEED_REQUESTS = metrics.Counter("deadbot_feed_requests_total", "Calendar feed requests, by response status", ("bot", "status"))
+COMMAND_SECONDS = metrics.Histogram("deadbot_command_seconds", "Time to handle a slash command, lock wait included", ("bot", "command"))
+
+def store_sizes():
+    return {(slash, team): data.size() for slash, bot in BOTS.items()
+            for team, data in bot.stores().items() if data.loaded.is_set()}
+
+def pending_announcements():
+    pending = collections.Counter(slash for slash, _ in SCHEDULER.keys())
+    return {(slash,): pending[slash] for slash in BOTS}
+
+metrics.Gauge("deadbot_store_size", "Records in each store", ("bot", "team"), store_sizes)
+metrics.Gauge("deadbot_pending_announcements", "Announcements waiting in the scheduler", ("bot",), pending_announcements)
+
+def wait_loaded(data, timeout=LOAD_WAIT):
+    deadline = time.monotonic() + timeout
+    while not data.loaded.wait(0.1):
+        if FAILED.is_set():
+            raise RuntimeError("The store failed to load")
+        if time.monotonic() > deadline:
+            raise TimeoutError("The store is still loading; try again shortly")
+
+class Bot:
+    def __init__(self, slash, data=None):
+        self.slash = slash
+        self.data = data
+        self.commands = dispatch.Dispatcher(slash)
+        BOTS[slash] = self
+
+    def command(self, *pattern, **opts):
+        return self.commands.command(*pattern, **opts)
+
+    def help(self):
+        return self.commands.help()
+
+    def options(self, args):
+        match = self.commands.match(args)
+        return match and match[0]
+
+    def handle(self, uid, args):
+        match = self.commands.match(args)
+        if not match:
+            return Ephemeral("I couldn't understand that command\n\n" + self.help())
+        opts, f, vars = match
+        wait_loaded(self.data)
+        print(" ".join(args), "(executing in {})".format(f.__name__))
+        lock = {"read": self.data.read, "write": self.data.lock}.get(opts["lock"], contextlib.nullcontext)
+        with COMMAND_SECONDS.time(self.slash, f.__name__), lock():
+            if opts["uid"]:
+                return f(uid, *vars)
+            else:
+                return f(*vars)
+
+    def schedule(self, key, due):
+        SCHEDULER.schedule((self.slash, key), due)
+
+    def cancel(self, key):
+        SCHEDULER.cancel((self.slash, key))
+
+    # Hooks for each bot
+
+    def arguments(self, parser):
+        pass
+
+    def configure(self, args):
+        pass
+
+    def stores(self):
+        """The bot's stores, by team"""
+        return {"": self.data}
+
+    def secrets(self):
+        """Slack signing secrets the bot accepts"""
+        return []
+
+    def unsigned(self):
+        """Whether some team still uses a verification token instead of signing"""
+        return True
+
+    def feed(self, query):
+        """The calendar name, store and a function listing the events (called
+        with the store read-locked) for GET <slash>.ics, or None if `query`
+        does not grant the feed"""
+        return None
+
+    def follow(self):
+        """Read from the snapshots a leader publishes instead of owning the
+        store; False if the bot cannot, and then the leader answers for it"""
+        return False
+
+    def authorize(self, data, secret):
+        """A context to handle the request in, or None to reject it.
+        `secret` is the signing secret that signed the request, if any."""
+        raise NotImplementedError
+
+    def startup(self):
+        """Load the store and schedule announcements"""
+        raise NotImplementedError
+
+    def announce(self, keys):
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Save the store; False if it never finished loading"""
+        raise NotImplementedError
+
+    def compact(self):
+        """Expire and snapshot each store this process has loaded"""
+        for data in self.stores().values():
+            if data.loaded.is_set():
+                with data.lock():
+                    data.save()
+
+# Requests are checked cheapest first: the declared length, then the
+# signature over the raw body, and only then is the body parsed and handed
+# to a bot to check the team.
+#
+# A follower, one with a `leader`, answers read-locked commands and feeds
+# for its `local` bots and passes every other request on to the leader.
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    bots = {}
+    verifier = verify.Verifier()
+    unsigned = True
+    # Slack's slash command payloads are well under a kilobyte
+    max_body = 16 * 1024
+    leader = None
+    local = ()
+
+    @classmethod
+    def serving(cls, *bots, leader=None, local=None):
+        return type(cls.__name__, (cls,), {
+            "bots": {bot.slash: bot for bot in bots},
+            "verifier": verify.Verifier([secret for bot in bots for secret in bot.secrets()]),
+            "unsigned": any(bot.unsigned() for bot in bots),
+            "leader": leader,
+            "local": {bot.slash for bot in (bots if local is None else local)},
+        })
+
+    def route(self, data):
+        if len(self.bots) == 1:
+            return next(iter(self.bots.values()))
+        return self.bots.get(data.get("command", [None])[0])
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/metrics":
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        bot = self.bots.get(path[:-len(".ics")]) if path.endswith(".ics") else None
+        if bot and bot.slash not in self.local:
+            return self.forward("GET", None)
+        feed = bot and bot.feed(urllib.parse.parse_qs(query))
+        if not feed:
+            self.send_error(404)
+            return
+        self.send_feed(bot, *feed)
+
+    # Calendar apps poll every few minutes, so an unchanged store is answered
+    # from its version alone, without the lock or any rendering
+    def send_feed(self, bot, name, data, events):
+        if not data.loaded.is_set():
+            FEED_REQUESTS.inc(bot.slash, "503")
+            self.send_error(503)
+            return
+        version, modified = data.version, data.modified
+        if self.unchanged(etag(version, modified), modified):
+            FEED_REQUESTS.inc(bot.slash, "304")
+            self.send_response(304)
+            self.send_header("ETag", etag(version, modified))
+            self.end_headers()
+            return
+        with data.read():
+            version, modified, events = data.version, data.modified, events()
+        FEED_REQUESTS.inc(bot.slash, "200")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("ETag", etag(version, modified))
+        self.send_header("Last-Modified", email.utils.formatdate(modified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        stream(self.wfile, calendars.feed(name, events, datetime.datetime.utcfromtimestamp(modified)))
+
+    def unchanged(self, tag, modified):
+        tags = self.headers["If-None-Match"]
+        if tags is not None:
+            return tags.strip() == "*" or tag in [t.strip().removeprefix("W/") for t in tags.split(",")]
+        since = self.headers["If-Modified-Since"]
+        try:
+            return since is not None and int(modified) <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def reject(self, code, reason):
+        REJECTED.inc(reason)
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def forward(self, method, body):
+        parts = urllib.parse.urlsplit(self.leader)
+        conn = (http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection)(parts.netloc, timeout=10)
+        headers = {name: self.headers[name] for name in FORWARD_HEADERS if name in self.headers}
+        try:
+            conn.request(method, parts.path.rstrip("/") + self.path, body=body, headers=headers)
+            res = conn.getresponse()
+            reply = res.read()
+        except (OSError, http.client.HTTPException) as e:
+            print("Forwarding to the leader failed:", e)
+            return self.reject(502, "leader")
+        finally:
+            conn.close()
+        FORWARDED.inc(str(res.status))
+        self.send_response(res.status)
+        for name in FORWARD_HEADERS + ["Content-Length"]:
+            if res.getheader(name):
+                self.send_header(name, res.getheader(name))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            return self.reject(411, "length")
+        if not 0 <= length <= self.max_body:
+            return self.reject(413, "size")
+        body = self.rfile.read(length)
+
+        # Slack signs every request, even for teams that only gave us a
+        # token; while some do, an unverified signature leaves `secret` None
+        # and the bot decides, since signed teams require their own secret
+        secret = None
+        if "X-Slack-Signature" in self.headers or not self.unsigned:
+            secret = self.verifier.verify(self.headers["X-Slack-Request-Timestamp"], self.headers["X-Slack-Signature"], body)
+            if not secret and not self.unsigned:
+                return self.reject(401, "signature")
+
+        data = urllib.parse.parse_qs(body.decode("utf-8", "replace"))
+        bot = self.route(data)
+        context = bot and bot.authorize(data, secret)
+        if not context:
+            return self.reject(400, "token")
+
+        uid = data["user_id"][0]
+        args = shlex.split(data["text"][0])
+        url = data.get("response_url", [None])[0]
+
+        opts = bot.options(args)
+        if self.leader and not (bot.slash in self.local and opts and opts["lock"] == "read"):
+            return self.forward("POST", body)
+
+        self.send_response(200)
+
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+
+        if url and opts and opts["defer"]:
+            if opts["public"]:
+                self.wfile.write(json.dumps({"response_type": "in_channel"}).encode("utf-8"))
+            DEFERRED.submit(reply, bot, context, uid, args, url)
+            return
+
+        self.wfile.write(json.dumps(payload(run(bot, context, uid, args))).encode("utf-8"))
+
+# Versions restart when a store loads, but the load is also a change, so
+# with the time of the last change the tag is unique. Followers publish the
+# leader's version and time, so they hand out the same tags.
+def etag(version, modified):
+    return '"{}-{:x}"'.format(version, int(modified * 1e6))
+
+def feed_token(query, token):
+    """Whether a feed request carries `token`"""
+    given = query.get("token", [""])[0]
+    return bool(token) and hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8"))
+
+def stream(wfile, pieces, size=64 * 1024):
+    buffer, n = [], 0
+    for piece in pieces:
+        buffer.append(piece.encode("utf-8"))
+        n += len(buffer[-1])
+        if n >= size:
+            wfile.write(b"".join(buffer))
+            buffer, n = [], 0
+    wfile.write(b"".join(buffer))
+
+# What the leader needs to check a request, and a feed reply's caching headers
+FORWARD_HEADERS = ["Content-Type", "X-Slack-Request-Timestamp", "X-Slack-Signature",
+                   "If-None-Match", "If-Modified-Since", "ETag", "Last-Modified", "Cache-Control"]
+
+def run(bot, context, uid, args):
+    try:
+        with context:
+            return bot.handle(uid, args)
+    except Exception as e:
+        traceback.print_exc()
+        return Ephemeral("*{}*: {}".format(type(e).__name__, e))
+
+def payload(response):
+    if response:
+        return {
+            "response_type": "in_channel" if isinstance(response, Response) else "ephemeral",
+            "text": str(response)
+        }
+    else:
+        return {"response_type": "in_channel"}
+
+def reply(bot, context, uid, args, url):
+    body = json.dumps(payload(run(bot, context, uid, args))).encode("utf-8")
+    conn = delivery.Connection(url)
+    try:
+        res = conn.post(body, {"Content-Type": "application/json"})
+    except (OSError, http.client.HTTPException) as e:
+        delivery.SLACK_FAILURES.inc(type(e).__name__)
+        print("Slack reply failed:", e)
+    else:
+        if res.status != 200:
+            delivery.SLACK_FAILURES.inc(str(res.status))
+            print("Scary reponse from Slack", res.status, res.reason)
+    finally:
+        conn.close()
+
+def startup(bots, httpd=None):
+    try:
+        for bot in bots:
+            bot.startup()
+        SCHEDULER.schedule(COMPACT, time.time() + COMPACT_INTERVAL)
+        SCHEDULER.start()
+    except BaseException:
+        FAILED.set()
+        if httpd:
+            httpd.shutdown()
+        raise
+
+def main(bots, port):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=port)
+    parser.add_argument("--workers", type=int, default=8, help="Number of requests served concurrently")
+    parser.add_argument("--fast-start", action="store_true", help="Accept requests while the store loads in the background")
+    parser.add_argument("--store", choices=["pickle", "sqlite"], default="pickle", help="Storage backend")
+    parser.add_argument("--follow", metavar="URL", help="Run as a read-only follower of the leader at URL")
+    for bot in bots:
+        bot.arguments(parser)
+    args = parser.parse_args()
+    for bot in bots:
+        bot.configure(args)
+    # A follower starts only the bots that can follow; the leader runs the rest
+    local = [bot for bot in bots if bot.follow()] if args.follow else bots
+    handler = RequestHandler.serving(*bots, leader=args.follow, local=local)
+    bots = local
+
+    if args.fast_start:
+        httpd = server.listen(handler, args.port, args.workers)
+        threading.Thread(target=startup, args=(bots, httpd), name="startup").start()
+    else:
+        startup(bots)
+        httpd = server.listen(handler, args.port, args.workers)
+
+    try:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            SCHEDULER.stop()
+    finally:
+        httpd.server_close()
+        DEFERRED.shutdown(wait=True)
+        loaded = [bot.shutdown() for bot in bots]
+        SLACK.drain()
+    if not all(loaded):
+        sys.exit(1)
@@ -0,0 +1,11 @@
+#!/bin/python3
+
+# Runs deadbot and birthbot in one process, behind one port, one Slack
+# outbox and one scheduler. Point both slash commands at this port.
+
+import bot
+import deadbot
+import birthbot
+
+if __name__ == "__main__":
+    bot.main([deadbot.BOT, birthbot.BOT], port=57005)
@@ -0,0 +1,151 @@
+import io
+import csv
+import json
+import datetime
+
+# Conference calendars in CSV, JSON or iCalendar, read into a list of
+# (line, name, "YYYY-MM-DD HH:MM", tz) entries. Every entry is checked
+# before anything is returned, and all problems are reported together, by
+# line and without repeating what the line says, since a calendar may have
+# been fetched from somewhere the person importing it cannot see.
+# `feed` writes events back out as an iCalendar feed.
+#
+#   CSV:       PLDI,2027-11-10,12:00,AOE      (tz optional; a header row is skipped)
+#   JSON:      [{"name": "PLDI", "date": "2027-11-10", "time": "12:00", "tz": "AOE"}]
+#              ("when": "2027-11-10 12:00" may replace date and time)
+#   iCalendar: VEVENTs; the first word of SUMMARY is the conference, and an
+#              all-day DTSTART is taken as 23:59 Anywhere on Earth
+
+DEFAULT_TZ = "PT"
+
+class CalendarError(ValueError):
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+# `check(when, tz)`, if given, reads each time in its time zone and raises
+# ValueError or KeyError if it cannot, so those errors are reported with
+# the rest; by default only the format is checked
+def parse(text, check=None):
+    text = text.strip()
+    if text.startswith("BEGIN:VCALENDAR"):
+        entries = parse_ical(text)
+    elif text.startswith("[") or text.startswith("{"):
+        entries = parse_json(text)
+    else:
+        entries = parse_csv(text)
+    errors = []
+    for line, name, when, tz in entries:
+        if not name:
+            errors.append("line {}: no conference name".format(line))
+            continue
+        try:
+            datetime.datetime.strptime(when, "%Y-%m-%d %H:%M")
+        except ValueError:
+            errors.append("line {}: no date and time like 2027-11-10 12:00".format(line))
+            continue
+        try:
+            if check: check(when, tz)
+        except (ValueError, KeyError):
+            errors.append("line {}: unknown time zone".format(line))
+    if errors:
+        raise CalendarError(errors)
+    return entries
+
+def parse_csv(text):
+    entries = []
+    for line, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        row = [cell.strip() for cell in row]
+        if not any(row) or row[0].startswith("#"): continue
+        if line == 1 and row[0].lower() in ("name", "conference", "conf"): continue
+        if len(row) < 3:
+            entries.append((line, row[0], " ".join(row[1:]), DEFAULT_TZ))
+            continue
+        entries.append((line, row[0], row[1] + " " + row[2], row[3] if len(row) > 3 and row[3] else DEFAULT_TZ))
+    return entries
+
+def parse_json(text):
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise CalendarError(["not valid JSON: {}".format(e)])
+    if isinstance(data, dict):
+        data = data.get("conferences", [data])
+    if not isinstance(data, list):
+        raise CalendarError(["conferences should be a list"])
+    entries = []
+    for line, item in enumerate(data, 1):
+        if not isinstance(item, dict):
+            entries.append((line, None, "", DEFAULT_TZ))
+            continue
+        when = item.get("when") or "{} {}".format(item.get("date", ""), item.get("time", ""))
+        entries.append((line, item.get("name") or item.get("conference"), when.strip(), item.get("tz") or DEFAULT_TZ))
+    return entries
+
+def parse_ical(text):
+    # Long lines are folded onto continuation lines that start with a space
+    lines = text.replace("\r\n", "\n").replace("\n ", "").replace("\n\t", "").split("\n")
+    entries = []
+    event = None
+    for line, content in enumerate(lines, 1):
+        name, _, value = content.partition(":")
+        prop, *params = name.split(";")
+        if prop == "BEGIN" and value == "VEVENT":
+            event = {"line": line}
+        elif prop == "END" and value == "VEVENT" and event is not None:
+            summary = event.get("SUMMARY", "").split()
+            entries.append((event["line"], summary[0] if summary else None, event.get("when", ""), event.get("tz", DEFAULT_TZ)))
+            event = None
+        elif event is not None and prop == "SUMMARY":
+            event["SUMMARY"] = value.replace("\\,", ",")
+        elif event is not None and prop == "DTSTART":
+            params = dict(param.partition("=")[::2] for param in params)
+            event["when"], event["tz"] = ical_time(value, params)
+    return entries
+
+def ical_time(value, params):
+    try:
+        if params.get("VALUE") == "DATE" or len(value) == 8:
+            return "{:%Y-%m-%d} 23:59".format(datetime.datetime.strptime(value, "%Y%m%d")), "AOE"
+        when = datetime.datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    except ValueError:
+        return value, DEFAULT_TZ
+    tz = "UTC" if value.endswith("Z") else params.get("TZID", DEFAULT_TZ)
+    return "{:%Y-%m-%d %H:%M}".format(when), tz
+
+# Events are (uid, summary, start, rule): a datetime start is in UTC, a date
+# start is all-day, and `rule` is an RRULE value or None. The feed comes out
+# one event at a time, with CRLF line endings and lines folded at 75 octets.
+def feed(name, events, stamp):
+    stamp = "DTSTAMP:{:%Y%m%dT%H%M%SZ}".format(stamp)
+    yield lines(["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//PLSE//deadbot//EN", "X-WR-CALNAME:" + escape(name)])
+    for uid, summary, start, rule in events:
+        if isinstance(start, datetime.datetime):
+            start = "DTSTART:{:%Y%m%dT%H%M%SZ}".format(start)
+        else:
+            start = "DTSTART;VALUE=DATE:{:%Y%m%d}".format(start)
+        yield lines(["BEGIN:VEVENT", "UID:" + escape(uid), stamp, start]
+                    + (["RRULE:" + rule] if rule else [])
+                    + ["SUMMARY:" + escape(summary), "END:VEVENT"])
+    yield lines(["END:VCALENDAR"])
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def lines(contents):
+    return "".join(fold(line) + "\r\n" for line in contents)
+
+def fold(line):
+    data = line.encode("utf-8")
+    parts = []
+    width = 75
+    while len(data) > width:
+        cut = width
+        # Do not split a UTF-8 sequence
+        while 0x80 <= data[cut] < 0xC0: cut -= 1
+        parts.append(data[:cut].decode("utf-8"))
+        data = data[cut:]
+        # Continuation lines start with a space
+        width = 74
+    parts.append(data.decode("utf-8"))
+    return "\r\n ".join(parts)
@@ -1,180 +1,240 @@
 #!/bin/python3
 
 import math
-import urllib.request
-import http.server
-import json
+import bisect
 import codecs
-import shlex
-import argparse
-from datetime import datetime, timedelta
-import arrow
+from datetime import datetime, timedelta, timezone
+import functools
 import collections
-import pickle
+import operator
+import itertools
 import os
-import threading
 import contextlib
+import contextvars
+import urllib.parse
 
-from _secret import HOOK, TOKEN
+import bot
+import server
+import calendars
+import replica
+import sign
+import store
+from bot import Ephemeral, Response, parse_uid
+
+import _secret
 
 def to_slack(msg : str):
-    req = urllib.request.Request(HOOK, data=json.dumps({"text": msg}).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=15) as res:
-        if res.getcode() == 200:
-            return
-        else:
-            raise IOError("Scary reponse from Slack", res)
+    bot.SLACK.put(msg, current().hook)
+
+SIGN = sign.Sign()
 
 def to_sign(conf, time):
-    data = urllib.parse.urlencode({ 'what': conf, 'when': '{:%Y-%m-%d %H:%M:%S GMT-0000}'.format(time) })
-    URL = "http://plseaudio.cs.washington.edu:8087/deadline"
-    req = urllib.request.Request(url=URL, data=data.encode("utf-8"), method="POST")
-    with urllib.request.urlopen(req, timeout=15) as res:
-        if res.getcode() == 200:
-            return
-        else:
-            raise IOError("Scary reponse from PLSE Sign", res)
+    SIGN.show(conf, time)
 
 def to_unsign():
-    URL = "http://plseaudio.cs.washington.edu:8087/restore_clock"
-    req = urllib.request.Request(url=URL, data=b"", method="POST")
-    with urllib.request.urlopen(req, timeout=15) as res:
-        if res.getcode() == 200:
-            return
-        else:
-            raise IOError("Scary reponse from PLSE Sign", res)
-
-def parse_date(string, tz):
-    tz_name = ({ "AOE": "Etc/GMT+12", "PT": "US/Pacific", "ET": "US/Eastern" }).get(tz, tz)
-    no_tz = arrow.get(string, "YYYY-MM-DD HH:mm")
-    return arrow.get(no_tz.datetime, tz_name).to("utc").datetime.replace(tzinfo=None)
+    SIGN.restore()
 
-def to_local(date):
-    return arrow.get(date, "US/Pacific").datetime
-
-class DeadlineRequestHandler(http.server.BaseHTTPRequestHandler):
-    def do_POST(self):
-        length = int(self.headers["Content-Length"])
-        data = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+TIMEZONES = { "AOE": "Etc/GMT+12", "PT": "US/Pacific", "ET": "US/Eastern" }
 
-        if data["token"] != [TOKEN]:
-            self.send_response(400)
-            self.end_headers()
-            return
+@functools.lru_cache(maxsize=None)
+def get_tz(tz):
+    import zoneinfo
+    return zoneinfo.ZoneInfo(TIMEZONES.get(tz, tz))
 
-        self.send_response(200)
-
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
+def parse_date(string, tz):
+    no_tz = datetime.strptime(string, "%Y-%m-%d %H:%M")
+    return no_tz.replace(tzinfo=get_tz(tz)).astimezone(timezone.utc).replace(tzinfo=None)
 
-        uid = data["user_id"][0]
-        args = ns(shlex.split(data["text"][0]))
+# US time zones change offset on the hour, so one UTC hour has one offset
+@functools.lru_cache(maxsize=4096)
+def local_offset(hour):
+    return hour.replace(tzinfo=timezone.utc).astimezone(get_tz("PT")).utcoffset()
 
-        with DATA.lock():
-            try:
-                response = handle(uid, args)
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                response = Ephemeral("*{}*: {}".format(type(e).__name__, e))
-        assert DATA.unlocked()
+def to_local(date):
+    return date + local_offset(date.replace(minute=0, second=0, microsecond=0))
 
-        if response:
-            self.wfile.write(json.dumps({
-                "response_type": "in_channel" if isinstance(response, Response) else "ephemeral",
-                "text": str(response)
-            }).encode("utf-8"))
+# Conferences as archived, returned by SQLite, and pickled before Occurrence
+Conference = collections.namedtuple("Conference", ["when", "who", "announcements"])
+WHEN = operator.attrgetter("when")
+
+# One occurrence of a conference in memory: submitters are bits over the
+# store's Users table and announcements are bits over days before the
+# deadline, so an occurrence is a datetime and two ints.
+class Occurrence:
+    __slots__ = ("when", "submitters", "announced", "users")
+
+    def __init__(self, when, submitters, announced, users):
+        self.when = when
+        self.submitters = submitters
+        self.announced = announced
+        self.users = users
+
+    @property
+    def who(self):
+        return self.users.members(self.submitters)
+
+    @property
+    def announcements(self):
+        return [days for days in range(self.announced.bit_length()) if self.announced >> days & 1]
+
+    # Pickled as microseconds since the epoch, which is smaller than a
+    # datetime; like Conference, only the class is named in the pickle
+    def __getstate__(self):
+        return ((self.when - EPOCH) // MICROSECOND, self.submitters, self.announced)
+
+    def __setstate__(self, state):
+        when, self.submitters, self.announced = state
+        self.when = EPOCH + when * MICROSECOND
+        self.users = None
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+class Deadlines(store.Store):
+    def __init__(self, root="."):
+        super().__init__(os.path.join(root, "data.pickle"), os.path.join(root, "data.journal"))
+        self.archive = store.Archive(os.path.join(root, "data.archive"), type(self).__module__)
+        self.deadlines = {}
+        self.index = []
+        # uid to the (when, name) of each conference they are submitting to
+        self.submissions = collections.defaultdict(set)
+        self.users = store.Users()
+
+    def snapshot(self):
+        return (self.users.uids, self.deadlines)
+
+    def restore(self, state):
+        if isinstance(state, dict):
+            # Saved before Occurrence, as lists of Conference
+            self.users = store.Users()
+            self.deadlines = {name: [Occurrence(conf.when, self.users.bits(conf.who), sum(1 << days for days in set(conf.announcements)), self.users)
+                                     for conf in opts]
+                              for name, opts in state.items()}
         else:
-            self.wfile.write(json.dumps({"response_type": "in_channel"}).encode("utf-8"))
-
-def start_server(port:int = 57005):
-    httpd = http.server.HTTPServer(("", port), DeadlineRequestHandler)
-    httpd.serve_forever()
-
-class Ephemeral(str): pass
-class Response(str): pass
-
-class ns:
-    def __init__(self, args):
-        self.args = args
-
-    def match(self, *pat):
-        out = []
-        if len(pat) != len(self.args):
-            return False
-        for val, arg in zip(pat, self.args):
-            if isinstance(val, list):
-                out.append(arg)
-            elif val == arg:
-                continue
-            else:
-                return False
-        self.vars = out
+            uids, self.deadlines = state
+            self.users = store.Users(uids)
+            for opts in self.deadlines.values():
+                for conf in opts:
+                    conf.users = self.users
+        self.reindex()
+
+    def size(self):
+        return len(self.deadlines)
+
+    def summary(self):
+        return "data about {} conferences".format(self.size())
+
+    def reindex(self):
+        for opts in self.deadlines.values():
+            opts.sort(key=WHEN)
+        self.index = sorted((conf.when, name) for name, conf in self.all())
+        self.submissions.clear()
+        for name, conf in self.all():
+            for uid in conf.who:
+                self.submissions[uid].add((conf.when, name))
+
+    # Past conferences go to the archive without their announcements, which
+    # only matter before the deadline
+    def expire(self):
+        expired = self.index[:bisect.bisect_left(self.index, (datetime.utcnow(),))]
+        if not expired: return False
+        self.archive.extend((name, Conference(when, self.occurrence(name, when).who, [])) for when, name in expired)
+        for when, name in expired:
+            self.delete(name, self.find(name, when))
+            if not self.deadlines[name]:
+                del self.deadlines[name]
         return True
 
-Conference = collections.namedtuple("Conference", ["when", "who", "announcements"])
-
-class Deadlines:
-    def __init__(self):
-        self.deadlines = None
-        self._deadlines = {}
-        self._lock = threading.Lock()
+    def apply(self, op, name, when, *args):
+        if op == "add":
+            self.insert(name, Occurrence(when, 0, 0, self.users))
+            return
+        idx = self.find(name, when)
+        conf = self.deadlines[name][idx]
+        if op == "set":
+            conf.submitters |= 1 << self.users.id(*args)
+            self.submissions[args[0]].add((when, name))
+        elif op == "unset":
+            bit = 1 << self.users.id(*args)
+            if not conf.submitters & bit: raise KeyError(*args)
+            conf.submitters ^= bit
+            self.unsubmit(args[0], when, name)
+        elif op == "modify":
+            self.delete(name, idx)
+            conf.when = args[0]
+            self.insert(name, conf)
+        elif op == "remove":
+            self.delete(name, idx)
+        elif op == "announce":
+            conf.announced |= 1 << args[0]
+        else:
+            raise ValueError("Unknown journal record {}".format(op))
+
+    def insert(self, name, conf):
+        bisect.insort(self.deadlines.setdefault(name, []), conf, key=WHEN)
+        bisect.insort(self.index, (conf.when, name))
+        for uid in conf.who:
+            self.submissions[uid].add((conf.when, name))
+
+    def delete(self, name, idx):
+        conf = self.deadlines[name].pop(idx)
+        del self.index[bisect.bisect_left(self.index, (conf.when, name))]
+        for uid in conf.who:
+            self.unsubmit(uid, conf.when, name)
+        return conf
+
+    def unsubmit(self, uid, when, name):
+        self.submissions[uid].discard((when, name))
+        if not self.submissions[uid]:
+            del self.submissions[uid]
+
+    def find(self, name, when):
+        opts = self.deadlines.get(name, [])
+        idx = bisect.bisect_left(opts, when, key=WHEN)
+        if idx == len(opts) or opts[idx].when != when:
+            raise KeyError("No conference {} on {}".format(name, when))
+        return idx
 
-    @contextlib.contextmanager
-    def lock(self):
-        self._lock.acquire()
-        self.deadlines = self._deadlines
-        yield
-        self._deadlines = self.deadlines
-        self.deadlines = None
-        self._lock.release()
-
-    def unlocked(self):
-        return not self.deadlines
-
-    def save(self):
-        with open("data.pickle", "wb") as fd:
-            pickle.dump(self.deadlines, fd)
-
-    def load(self):
-        if os.path.exists("data.pickle"):
-            with open("data.pickle", "rb") as fd:
-                self.deadlines = pickle.load(fd)
-                print("Loaded data about {} conferences".format(len(self.deadlines)))
+    def occurrence(self, name, when):
+        return self.deadlines[name][self.find(name, when)]
 
     def get_conf(self, name, when):
-        opts = self.deadlines.get(name, [])
-        confs = [conf for conf in opts if when < conf.when]
-        if not confs: raise KeyError("No conference {}".format(name))
-        return min(confs, key=lambda x: x.when)
+        return self.get_conf_idx(name, when)[1]
 
     def get_conf_idx(self, name, when):
         opts = self.deadlines.get(name, [])
-        confs = [(i, conf) for i, conf in enumerate(opts) if when < conf.when]
-        if not confs: raise KeyError("No conference {}".format(name))
-        return min(confs, key=lambda x: x[1].when)
+        idx = bisect.bisect_right(opts, when, key=WHEN)
+        if idx == len(opts): raise KeyError("No conference {}".format(name))
+        return idx, opts[idx]
 
     def set(self, name, when, uid):
-        self.get_conf(name, when).who.add(uid)
-        self.save()
+        self.set_all([name], when, uid)
 
     def unset(self, name, when, uid):
-        self.get_conf(name, when).who.remove(uid)
-        self.save()
+        self.unset_all([name], when, uid)
+
+    # Every conference is looked up before any is changed, so an unknown
+    # name leaves them all as they were
+    def set_all(self, names, when, uid):
+        self.commit_many([("set", name, self.get_conf(name, when).when, uid) for name in names])
+
+    def unset_all(self, names, when, uid):
+        confs = [(name, self.get_conf(name, when)) for name in dict.fromkeys(names)]
+        for name, conf in confs:
+            if uid not in conf.who: raise KeyError(uid)
+        self.commit_many([("unset", name, conf.when, uid) for name, conf in confs])
 
     def add(self, name, when):
-        self.deadlines.setdefault(name, []).append(Conference(when, set(), []))
-        self.save()
+        self.commit("add", name, when)
 
     def modify(self, name, old_when, new_when):
-        idx, conf = self.get_conf_idx(name, old_when)
-        self.deadlines[name][idx] = Conference(new_when, conf.who, conf.announcements)
-        self.save()
+        self.commit("modify", name, self.get_conf(name, old_when).when, new_when)
 
     def remove(self, name, when):
-        idx, conf = self.get_conf_idx(name, when)
-        del self.deadlines[name][idx]
-        self.save()
+        self.commit("remove", name, self.get_conf(name, when).when)
+
+    def announced(self, name, when, days):
+        self.commit("announce", name, when, days)
 
     def who(self, name, when):
         return self.get_conf(name, when).who
@@ -182,13 +242,31 @@ class Deadlines:
     def when(self, name, when):
         return self.get_conf(name, when).when
 
+    def occurrences(self, name, when):
+        opts = self.deadlines.get(name, [])
+        return [conf.when for conf in opts[bisect.bisect_right(opts, when, key=WHEN):]]
+
+    def mine(self, uid, when):
+        return [(name, self.occurrence(name, w)) for w, name in sorted(self.submissions.get(uid, ())) if w > when]
+
+    def after(self, when):
+        return self.index[bisect.bisect_right(self.index, when, key=lambda x: x[0]):]
+
+    def history(self, name, when):
+        past = {conf.when: conf for archived, conf in self.archive if archived == name}
+        for conf in self.deadlines.get(name, []):
+            if conf.when <= when:
+                past.setdefault(conf.when, conf)
+        return [past[w] for w in sorted(past)]
+
     def upcoming(self, when):
         out = []
-        for name, opts in self.deadlines.items():
-            confs = list(filter(lambda conf: when < conf.when, opts))
-            if confs:
-                out.append((name, min(confs, key=lambda x: x.when)))
-        return sorted(out, key=lambda x: x[1].when)
+        seen = set()
+        for _, name in self.after(when):
+            if name in seen: continue
+            seen.add(name)
+            out.append((name, self.get_conf(name, when)))
+        return out
 
     def all(self):
         out = []
@@ -197,7 +275,167 @@ class Deadlines:
                 out.append((name, opt))
         return out
 
-DATA = Deadlines()
+DEADLINES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conferences (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    "when" TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conferences_name_when ON conferences (name, "when");
+CREATE INDEX IF NOT EXISTS conferences_when ON conferences ("when");
+CREATE TABLE IF NOT EXISTS submitters (
+    conference INTEGER NOT NULL REFERENCES conferences (id) ON DELETE CASCADE,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (conference, uid)
+);
+CREATE INDEX IF NOT EXISTS submitters_uid ON submitters (uid);
+CREATE TABLE IF NOT EXISTS announcements (
+    conference INTEGER NOT NULL REFERENCES conferences (id) ON DELETE CASCADE,
+    days INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS announcements_conference ON announcements (conference);
+"""
+
+class SqliteDeadlines(store.SqliteStore, Deadlines):
+    def __init__(self, root="."):
+        super().__init__(root)
+        self.db = store.Database(os.path.join(root, "data.sqlite"), DEADLINES_SCHEMA)
+
+    def size(self):
+        n, = self.db.execute("SELECT COUNT(DISTINCT name) FROM conferences").fetchone()
+        return n
+
+    def apply(self, op, name, when, *args):
+        if op == "add":
+            self.db.execute('INSERT INTO conferences (name, "when") VALUES (?, ?)', (name, store.sqltime(when)))
+            return
+        cid = self.find(name, when)
+        if op == "set":
+            self.db.execute("INSERT OR IGNORE INTO submitters VALUES (?, ?)", (cid, *args))
+        elif op == "unset":
+            if not self.db.execute("DELETE FROM submitters WHERE conference = ? AND uid = ?", (cid, *args)).rowcount:
+                raise KeyError(*args)
+        elif op == "modify":
+            self.db.execute('UPDATE conferences SET "when" = ? WHERE id = ?', (store.sqltime(args[0]), cid))
+        elif op == "remove":
+            self.db.execute("DELETE FROM conferences WHERE id = ?", (cid,))
+        elif op == "announce":
+            self.db.execute("INSERT INTO announcements VALUES (?, ?)", (cid, *args))
+        else:
+            raise ValueError("Unknown journal record {}".format(op))
+
+    def find(self, name, when):
+        row = self.db.execute('SELECT id FROM conferences WHERE name = ? AND "when" = ? LIMIT 1', (name, store.sqltime(when))).fetchone()
+        if not row: raise KeyError("No conference {} on {}".format(name, when))
+        return row[0]
+
+    def conferences(self, rows):
+        rows = list(rows)
+        ids = ",".join(str(cid) for cid, _, _ in rows)
+        who = collections.defaultdict(set)
+        announcements = collections.defaultdict(list)
+        for cid, uid in self.db.execute("SELECT conference, uid FROM submitters WHERE conference IN ({})".format(ids)):
+            who[cid].add(uid)
+        for cid, days in self.db.execute("SELECT conference, days FROM announcements WHERE conference IN ({}) ORDER BY rowid".format(ids)):
+            announcements[cid].append(days)
+        return [(name, Conference(datetime.fromisoformat(when), who[cid], announcements[cid])) for cid, name, when in rows]
+
+    def occurrence(self, name, when):
+        return self.conferences([(self.find(name, when), name, store.sqltime(when))])[0][1]
+
+    def occurrences(self, name, when):
+        return [datetime.fromisoformat(w) for w, in
+                self.db.execute('SELECT "when" FROM conferences WHERE name = ? AND "when" > ? ORDER BY "when"', (name, store.sqltime(when)))]
+
+    # Past conferences stay in the table, indexed by time, as history
+    def expire(self):
+        with self.db.transaction():
+            self.db.execute('DELETE FROM announcements WHERE conference IN (SELECT id FROM conferences WHERE "when" < ?)',
+                            (store.sqltime(datetime.utcnow()),))
+        return False
+
+    def history(self, name, when):
+        rows = self.db.execute('SELECT id, name, "when" FROM conferences WHERE name = ? AND "when" <= ? ORDER BY "when"', (name, store.sqltime(when)))
+        return [conf for _, conf in self.conferences(rows)]
+
+    def get_conf(self, name, when):
+        rows = self.db.execute('SELECT id, name, "when" FROM conferences WHERE name = ? AND "when" > ? ORDER BY "when" LIMIT 1', (name, store.sqltime(when))).fetchall()
+        if not rows: raise KeyError("No conference {}".format(name))
+        return self.conferences(rows)[0][1]
+
+    def mine(self, uid, when):
+        return self.conferences(self.db.execute('SELECT id, name, "when" FROM conferences JOIN submitters ON conference = id '
+                                                'WHERE uid = ? AND "when" > ? ORDER BY "when", name', (uid, store.sqltime(when))))
+
+    def after(self, when):
+        return [(datetime.fromisoformat(w), name) for w, name in
+                self.db.execute('SELECT "when", name FROM conferences WHERE "when" > ? ORDER BY "when", name', (store.sqltime(when),))]
+
+    def upcoming(self, when):
+        # SQLite takes the bare columns from the row that holds the MIN
+        rows = self.db.execute('SELECT id, name, MIN("when") AS next FROM conferences WHERE "when" > ? GROUP BY name ORDER BY next, name', (store.sqltime(when),))
+        return self.conferences(rows)
+
+    def all(self):
+        return self.conferences(self.db.execute('SELECT id, name, "when" FROM conferences ORDER BY name, "when"'))
+
+    def migrate(self, deadlines):
+        seen = set()
+        with self.db.transaction():
+            for name, conf in itertools.chain(deadlines.archive, deadlines.all()):
+                if (name, conf.when) in seen: continue
+                seen.add((name, conf.when))
+                cid = self.db.execute('INSERT INTO conferences (name, "when") VALUES (?, ?)', (name, store.sqltime(conf.when))).lastrowid
+                self.db.executemany("INSERT OR IGNORE INTO submitters VALUES (?, ?)", [(cid, uid) for uid in conf.who])
+                self.db.executemany("INSERT INTO announcements VALUES (?, ?)", [(cid, days) for days in conf.announcements])
+
+# One research group's Slack team: its own store, lock and webhook
+class Tenant:
+    def __init__(self, team, token, hook, root=".", backend="pickle", secret=None, feed_token=None):
+        self.team = team
+        self.token = token
+        self.hook = hook
+        self.root = root
+        self.secret = secret
+        self.feed_token = feed_token
+        self.data = (SqliteDeadlines if backend == "sqlite" else Deadlines)(root)
+
+    # Teams with a signing secret no longer accept the deprecated token
+    def authorized(self, data, secret):
+        if self.secret:
+            return secret == self.secret
+        return data.get("token") == [self.token]
+
+    @contextlib.contextmanager
+    def active(self):
+        token = CURRENT.set(self)
+        try:
+            yield self
+        finally:
+            CURRENT.reset(token)
+
+def load_tenants(backend="pickle"):
+    tenants = {}
+    if hasattr(_secret, "TOKEN") or hasattr(_secret, "SIGNING_SECRET"):
+        tenants[None] = Tenant(None, getattr(_secret, "TOKEN", None), _secret.HOOK, ".", backend,
+                               getattr(_secret, "SIGNING_SECRET", None), getattr(_secret, "FEED_TOKEN", None))
+    for team, conf in getattr(_secret, "TEAMS", {}).items():
+        tenants[team] = Tenant(team, conf.get("token"), conf["hook"], conf.get("root", team), conf.get("store", backend),
+                               conf.get("signing_secret"), conf.get("feed_token"))
+    return tenants
+
+TENANTS = load_tenants()
+CURRENT = contextvars.ContextVar("tenant", default=None)
+
+def current():
+    return CURRENT.get() or TENANTS[None]
+
+# The store of the tenant whose request or announcement is being handled
+class CurrentStore:
+    def __getattr__(self, attr):
+        return getattr(current().data, attr)
+
+DATA = CurrentStore()
 
 def describe_who(who, conf):
     if who:
@@ -206,49 +444,205 @@ def describe_who(who, conf):
         names = "No one"
     return names + " " + ("are" if len(who) > 1 else "is") + " submitting to " + conf_name(conf)
 
-def parse_uid(user):
-    assert user[0] == "<"
-    assert user[-1] == ">"
-    assert user[1] == "@"
-    return user[2:-1].split("|")[0]
+# Leaders started with --publish keep data.replica in each team's root up
+# to date; followers on the same machine map it and answer reads from it.
+PUBLISH = False
+FOLLOWING = False
+PUBLISHERS = []
+
+def replica_path(tenant):
+    return os.path.join(tenant.root, "data.replica")
+
+class Deadbot(bot.Bot):
+    def arguments(self, parser):
+        parser.add_argument("--sign", default=sign.URL, help="URL of the PLSE sign")
+        parser.add_argument("--publish", action="store_true", help="Publish snapshots for --follow processes")
+
+    def configure(self, args):
+        global SIGN, TENANTS, PUBLISH
+        SIGN = sign.Sign(args.sign)
+        TENANTS = load_tenants(args.store)
+        PUBLISH = args.publish
+
+    def follow(self):
+        global FOLLOWING
+        FOLLOWING = True
+        for tenant in TENANTS.values():
+            tenant.data = replica.Replica(replica_path(tenant), store.Archive(os.path.join(tenant.root, "data.archive"), __name__))
+        return True
 
-COMMANDS = []
+    def stores(self):
+        return {tenant.team or "": tenant.data for tenant in TENANTS.values()}
+
+    def secrets(self):
+        return [tenant.secret for tenant in TENANTS.values() if tenant.secret]
+
+    def unsigned(self):
+        return any(not tenant.secret for tenant in TENANTS.values())
+
+    def authorize(self, data, secret):
+        tenant = TENANTS.get(data.get("team_id", [None])[0]) or TENANTS.get(None)
+        if tenant and tenant.authorized(data, secret):
+            return tenant.active()
+
+    # GET /deadline.ics?team=T...&token=..., for teams with a feed_token
+    def feed(self, query):
+        tenant = TENANTS.get(query.get("team", [None])[0])
+        if tenant and bot.feed_token(query, tenant.feed_token):
+            return "Deadlines", tenant.data, lambda: deadline_events(tenant.data)
+
+    def startup(self):
+        for tenant in TENANTS.values():
+            os.makedirs(tenant.root, exist_ok=True)
+            with tenant.active(), DATA.lock():
+                DATA.load()
+                if DATA.dirty() or DATA.expire():
+                    DATA.save()
+            if PUBLISH:
+                PUBLISHERS.append(replica.Publisher(tenant.data, replica_path(tenant)).start())
+        # The leader makes the announcements
+        if not FOLLOWING:
+            start_announcements()
+
+    def announce(self, keys):
+        make_announcements(keys)
+
+    def shutdown(self):
+        for publisher in PUBLISHERS:
+            publisher.stop()
+        for tenant in TENANTS.values():
+            if tenant.data.loaded.is_set():
+                with tenant.active(), DATA.lock():
+                    DATA.save()
+        return all(tenant.data.loaded.is_set() for tenant in TENANTS.values())
+
+BOT = Deadbot("/deadline", DATA)
+COMMANDS = BOT.commands
+command = BOT.command
+DeadlineRequestHandler = bot.RequestHandler.serving(BOT)
 
 def handle(uid, args):
-    for pattern, opts, f in COMMANDS:
-        if args.match(*pattern):
-            print(" ".join(args.args), "(executing in {})".format(f.__name__))
-            if opts["uid"]:
-                return f(uid, *args.vars)
-            else:
-                return f(*args.vars)
-    else:
-        return Ephemeral("I couldn't understand that command\n\n" + help())
+    return BOT.handle(uid, args)
+
+def start_server(port:int = 57005, workers:int = 8):
+    server.serve(DeadlineRequestHandler, port, workers)
 
-def command(*pattern, uid=False, public=False):
-    def decorator(f):
-        COMMANDS.append((pattern, { "uid": uid, "public": public }, f))
-        return f
-    return decorator
+ANNOUNCE_DAYS = [28, 21, 14, 7, 6, 5, 4, 3, 2, 1, 0]
 
-def new_announcements():
+def new_announcements(due):
     now = datetime.utcnow()
-    announce_days = [28, 21, 14, 7, 6, 5, 4, 3, 2, 1, 0]
     out = []
-    for name, conf in DATA.all():
+    for name, when in due:
+        try:
+            conf = DATA.occurrence(name, when)
+        except KeyError:
+            continue
         if conf.when < now: continue
-        if conf.when > now + timedelta(days=max(announce_days)): continue
+        if conf.when > now + timedelta(days=max(ANNOUNCE_DAYS)): continue
         if not conf.who: continue
         announce = False
-        for days in announce_days:
+        for days in ANNOUNCE_DAYS:
             if conf.when < now + timedelta(days=days) \
                and days not in conf.announcements:
                 announce = True
-                conf.announcements.append(days)
+                DATA.announced(name, conf.when, days)
         if announce:
             out.append((name, conf))
     return out
 
+def next_announcement(conf):
+    if not conf.who: return None
+    dues = [conf.when - timedelta(days=days) for days in ANNOUNCE_DAYS
+            if days not in conf.announcements and days > 0]
+    return min(dues, default=None)
+
+def schedule(name, when):
+    try:
+        conf = DATA.occurrence(name, when)
+    except KeyError:
+        conf = None
+    due = conf and next_announcement(conf)
+    if due:
+        BOT.schedule((current().team, name, when), due.replace(tzinfo=timezone.utc).timestamp())
+    else:
+        BOT.cancel((current().team, name, when))
+
+def reschedule(op, name, when, *args):
+    if op == "modify":
+        BOT.cancel((current().team, name, when))
+        when, = args
+    schedule(name, when)
+
+# A calendar date this close to an existing deadline moves it rather than
+# adding another occurrence
+IMPORT_MOVE_WINDOW = timedelta(days=180)
+
+# `entries` come from calendars.parse with parse_date as the check
+def plan_import(entries, now):
+    dates = collections.defaultdict(set)
+    for line, name, when, tz in entries:
+        dates[conf_name(name)].add(parse_date(when, tz))
+
+    records, report = [], []
+    unchanged = skipped = 0
+    for name, whens in dates.items():
+        existing = set(DATA.occurrences(name, now))
+        new = sorted(when for when in whens - existing if when > now)
+        skipped += sum(when <= now for when in whens)
+        unchanged += len(whens & existing)
+        existing -= whens
+        for when in new:
+            near = [old for old in existing if abs(old - when) < IMPORT_MOVE_WINDOW]
+            if near:
+                old = min(near, key=lambda old: abs(old - when))
+                existing.remove(old)
+                records.append(("modify", name, old, when))
+                report.append("• Moved {} from {} to {}".format(name, print_localdate(old), print_utcdate(when)))
+            else:
+                records.append(("add", name, when))
+                report.append("• Added {} on {}".format(name, print_utcdate(when)))
+    return records, report, unchanged, skipped
+
+# Calendars are only fetched over https from the hosts in CALENDAR_HOSTS,
+# and only from public addresses with no redirects, so an import cannot
+# reach the bot itself or anything else on its network. With no hosts
+# listed, calendars have to be pasted.
+CALENDAR_HOSTS = set(getattr(_secret, "CALENDAR_HOSTS", ()))
+MAX_CALENDAR = 1 << 20
+
+def fetch_calendar(url):
+    import ssl
+    import socket
+    import ipaddress
+    import http.client
+    parts = urllib.parse.urlsplit(url)
+    if not CALENDAR_HOSTS:
+        raise ValueError("Importing calendars by URL is not enabled; paste the calendar instead")
+    if parts.scheme != "https" or parts.hostname not in CALENDAR_HOSTS:
+        raise ValueError("Calendars can only be fetched over https from {}".format(list_names(sorted(CALENDAR_HOSTS))))
+    host, port = parts.hostname, parts.port or 443
+    # Connect to the address that was checked, not whatever a second lookup returns
+    addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    if not addresses or not all(ipaddress.ip_address(address.split("%")[0]).is_global for address in addresses):
+        raise ValueError("{} is not a public address".format(host))
+    context = ssl.create_default_context()
+    conn = http.client.HTTPSConnection(host, port, timeout=10, context=context)
+    try:
+        conn.sock = context.wrap_socket(socket.create_connection((addresses[0], port), timeout=10), server_hostname=host)
+        conn.request("GET", (parts.path or "/") + ("?" + parts.query if parts.query else ""))
+        res = conn.getresponse()
+        if res.status != 200:
+            raise ValueError("Calendar at {} returned {}".format(url, res.status))
+        body = res.read(MAX_CALENDAR + 1)
+    finally:
+        conn.close()
+    if len(body) > MAX_CALENDAR:
+        raise ValueError("Calendar at {} is over {} bytes".format(url, MAX_CALENDAR))
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("Calendar at {} is not UTF-8 text".format(url)) from None
+
 def days_ago(date):
     n = round((date - datetime.utcnow()) / timedelta(days=1))
     return ("1 day" if n == 1 else "{} days".format(n))
@@ -256,73 +650,94 @@ def days_ago(date):
 def conf_name(conf):
     return conf.upper() if conf.islower() else conf
 
+def list_names(names):
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+
+@functools.lru_cache(maxsize=4096)
+def print_localdate(date):
+    return "{:%d %b at %H:%M}".format(to_local(date))
+
 def print_utcdate(date):
-    return "{:%d %b at %H:%M} ({})".format(arrow.get(date).to("US/Pacific").datetime, days_ago(date))
+    return "{} ({})".format(print_localdate(date), days_ago(date))
 
-def make_announcements():
-    now = datetime.utcnow()
-    for name, conf in new_announcements():
-        print("Announcing", name, "on", conf.when)
-        delta = math.ceil((conf.when - now) / timedelta(days=1))
-        who = ", ".join(["<@{}>".format(uid) for uid in conf.who])
-        if delta == 0:
-            to_slack("{} deadline! Congrats to everyone who submitted!".format(name))
-        else:
-            to_slack("{} is in {}! Good luck {}".format(name, days_ago(conf.when), who))
+def make_announcements(due):
+    by_tenant = collections.defaultdict(list)
+    for team, name, when in due:
+        by_tenant[team].append((name, when))
+    for team, confs in by_tenant.items():
+        with TENANTS[team].active():
+            announce_deadlines(confs)
 
-def start_announcement_thread():
+def announce_deadlines(due):
+    now = datetime.utcnow()
+    messages = []
     with DATA.lock():
-        try:
-            make_announcements()
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-        DATA.save()
-
-    assert DATA.unlocked()
+        for name, conf in new_announcements(due):
+            print("Announcing", name, "on", conf.when)
+            delta = math.ceil((conf.when - now) / timedelta(days=1))
+            who = ", ".join(["<@{}>".format(uid) for uid in conf.who])
+            if delta == 0:
+                messages.append("{} deadline! Congrats to everyone who submitted!".format(name))
+            else:
+                messages.append("{} is in {}! Good luck {}".format(name, days_ago(conf.when), who))
+    for msg in messages:
+        to_slack(msg)
 
-    FREQUENCY = 60 * 60
-    timer = threading.Timer(FREQUENCY, start_announcement_thread)
-    timer.start()
-    return timer
+def start_announcements():
+    now = datetime.utcnow()
+    for tenant in TENANTS.values():
+        with tenant.active(), DATA.read():
+            for when, name in DATA.after(now):
+                schedule(name, when)
+        tenant.data.watchers.append(reschedule)
 
 class Commands:
-    @command(["user"], "set", ["conf"])
-    def set_user(user, conf):
-        """Declare that someone is submitting to a conference"""
+    @command(["user"], "set", ["conf", ...])
+    def set_user(user, confs):
+        """Declare that someone is submitting to conferences"""
         uid2 = parse_uid(user)
-        return Commands.set(uid2, conf)
+        return Commands.set(uid2, confs)
 
-    @command("set", ["conf"], uid=True)
-    def set(uid, conf):
-        """Declare that you are submitting to a conference"""
-        conf = conf_name(conf)
+    @command("set", ["conf", ...], uid=True)
+    def set(uid, confs):
+        """Declare that you are submitting to conferences"""
+        confs = [conf_name(conf) for conf in confs]
         try:
-            DATA.set(conf, datetime.utcnow(), uid)
-            return Response("Good luck, <@{}>, on {}!".format(uid, conf))
+            DATA.set_all(confs, datetime.utcnow(), uid)
+            return Response("Good luck, <@{}>, on {}!".format(uid, list_names(confs)))
         except ValueError:
-            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(conf))
+            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(list_names(confs)))
 
-    @command(["user"], "unset", ["conf"])
-    def unset_user(user, conf):
-        """Declare that someone is no longer submitting to a conference"""
+    @command(["user"], "unset", ["conf", ...])
+    def unset_user(user, confs):
+        """Declare that someone is no longer submitting to conferences"""
         uid = parse_uid(user)
-        conf = conf_name(conf)
+        confs = [conf_name(conf) for conf in confs]
         try:
-            DATA.unset(conf, datetime.utcnow(), uid)
+            DATA.unset_all(confs, datetime.utcnow(), uid)
             return Ephemeral("Sorry to hear that.")
         except ValueError:
-            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(conf))
+            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(list_names(confs)))
 
-    @command("unset", ["conf"], uid=True)
-    def unset(uid, conf):
-        """Declare that you are no longer submitting to a conference"""
-        conf = conf_name(conf)
+    @command("unset", ["conf", ...], uid=True)
+    def unset(uid, confs):
+        """Declare that you are no longer submitting to conferences"""
+        confs = [conf_name(conf) for conf in confs]
         try:
-            DATA.unset(conf, datetime.utcnow(), uid)
-            return Ephemeral("Patience is bitter, but its fruit is sweet, <@{}>!".format(uid, conf))
+            DATA.unset_all(confs, datetime.utcnow(), uid)
+            return Ephemeral("Patience is bitter, but its fruit is sweet, <@{}>!".format(uid))
         except ValueError:
-            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(conf))
+            return Ephemeral("Conference {} does not yet exit. Please `/deadline add` it.".format(list_names(confs)))
+
+    @command("mine", uid=True, lock="read")
+    def mine(uid):
+        """List the upcoming conferences you are submitting to"""
+        mine = DATA.mine(uid, datetime.utcnow())
+        if not mine:
+            return Ephemeral("You are not submitting to anything yet. `/deadline set CONF` to start.")
+        return Ephemeral("You are submitting to:\n" + "\n".join([
+            "• {} on {}".format(name, print_utcdate(conf.when))
+            for name, conf in mine]))
 
     @command("add", ["conf"], ["date"], ["time"], ["tz"])
     def add_tz(conf, date, time, tz):
@@ -361,89 +776,98 @@ class Commands:
         DATA.remove(conf, now)
         return Ephemeral("Removed {} on {}".format(conf, print_utcdate(when)))
 
-    @command("when", ["conf"])
+    @command("import", ["calendar"], lock=None, defer=True)
+    def import_calendar(calendar):
+        """Add or move conferences from a CSV, JSON or iCalendar file, quoted or by https URL"""
+        text = fetch_calendar(calendar) if calendar.startswith(("http://", "https://")) else calendar
+        try:
+            entries = calendars.parse(text, check=parse_date)
+            with DATA.lock():
+                records, report, unchanged, skipped = plan_import(entries, datetime.utcnow())
+                DATA.commit_many(records)
+        except calendars.CalendarError as e:
+            return Ephemeral("Nothing imported. Please fix:\n" + "\n".join("• " + error for error in e.errors))
+        summary = "Imported {} conferences: {} added or moved, {} unchanged, {} already past.".format(
+            len(entries), len(records), unchanged, skipped)
+        return Response("\n".join([summary] + report))
+
+    @command("when", ["conf"], lock="read")
     def when(conf):
         """When is a conference?"""
         conf = conf_name(conf)
         when = DATA.when(conf, datetime.utcnow())
         return Ephemeral("{} is on {}".format(conf, print_utcdate(when)))
 
-    @command("who", ["conf"])
+    @command("who", ["conf"], lock="read")
     def who(conf):
         """Who is submitting to a conference?"""
         conf = conf_name(conf)
         who = DATA.who(conf, datetime.utcnow())
         return Ephemeral(describe_who(who, conf))
 
-    @command("upcoming", public=True)
+    @command("history", ["conf"], lock="read")
+    def history(conf):
+        """List past deadlines of a conference"""
+        conf = conf_name(conf)
+        past = DATA.history(conf, datetime.utcnow())
+        if not past:
+            return Ephemeral("{} has no past deadlines".format(conf))
+        return Ephemeral("Past {} deadlines:\n".format(conf) + "\n".join([
+            "• {:%d %b %Y} — {}".format(to_local(c.when), ", ".join(["<@{}>".format(uid) for uid in c.who]) or "no one")
+            for c in past]))
+
+    @command("upcoming", public=True, lock="read", defer=True)
     def upcoming():
         """List upcoming deadlines"""
-        upcoming = DATA.upcoming(datetime.utcnow())
-        return Response("The following deadlines are coming up:\n" + "\n".join([
-            "• {} on {}".format(name, print_utcdate(conf.when))
-            for name, conf in upcoming]))
+        now = datetime.utcnow()
+        return Response(DATA.cached("upcoming", now, lambda: render_upcoming(now)))
 
-    @command("announce", ["conf"], public=True)
+    @command("announce", ["conf"], public=True, lock="read")
     def announce(conf):
         """Announce who is submitting to a conference"""
         conf = conf_name(conf)
         who = DATA.who(conf, datetime.utcnow())
         return Response(describe_who(who, conf))
 
-    @command("sign", ["conf"], public=True)
+    @command("sign", ["conf"], public=True, lock=None)
     def sign(conf):
         """Announce who is submitting to a conference"""
         conf = conf_name(conf)
-        when = DATA.when(conf, datetime.utcnow())
+        with DATA.read():
+            when = DATA.when(conf, datetime.utcnow())
         to_sign(conf, when)
         return Ephemeral("{} on {} sent to sign!".format(conf, print_utcdate(when)))
 
-    @command("sign")
+    @command("sign", lock=None)
     def sign():
         """Announce who is submitting to a conference"""
         to_unsign()
         return Ephemeral("Sign restored")
 
-    @command("help")
+    @command("help", lock=None)
     def help():
         return Ephemeral(help())
 
-FORMATS = {
-    "user": "@USER",
-    "date": "YYYY-MM-DD",
-    "time": "HH:MM",
-}
+def deadline_events(data):
+    return [("{}-{:%Y%m%dT%H%M}@deadbot".format(name, conf.when), name + " deadline", conf.when, None)
+            for name, conf in data.all()]
+
+def render_upcoming(now):
+    upcoming = DATA.upcoming(now)
+    text = "The following deadlines are coming up:\n" + "\n".join([
+        "• {} on {}".format(name, print_utcdate(conf.when))
+        for name, conf in upcoming])
+    return text, min([countdown_changes(conf.when, now) for _, conf in upcoming], default=datetime.max)
+
+# When days_ago(when) next rounds to a different number, or `when` passes
+def countdown_changes(when, now):
+    days = round((when - now) / timedelta(days=1))
+    return min(when, when - (days - 0.5) * timedelta(days=1))
 
 def help():
-    private = "I understand the following commands:\n\n"
-    public = "Public announcement commands:\n\n"
-    for pattern, opts, f in COMMANDS:
-        if not f.__doc__: continue
-        s = "• `/deadline "
-        for val in pattern:
-            if isinstance(val, list):
-                s += FORMATS.get(val[0], val[0].upper())
-            else:
-                s += val
-            s += " "
-        s += "` — " + str(f.__doc__) + "\n"
-        if opts["public"]:
-            public += s
-        else:
-            private += s
-    return private + "\n" + public
+    return BOT.help()
 
+# Run through the module, so what it pickles names deadbot and not __main__
 if __name__ == "__main__":
-    with DATA.lock():
-        DATA.load()
-    assert DATA.unlocked()
-
-    try:
-        announce_thread = start_announcement_thread()
-        try:
-            start_server()
-        except KeyboardInterrupt:
-            announce_thread.cancel()
-    finally:
-        with DATA.lock():
-            DATA.save()
+    import deadbot
+    bot.main([deadbot.BOT], port=57005)
@@ -0,0 +1,147 @@
+import json
+import time
+import queue
+import threading
+import traceback
+import email.utils
+import http.client
+import urllib.parse
+
+import metrics
+
+SLACK_SECONDS = metrics.Histogram("deadbot_slack_post_seconds", "Latency of posts to Slack webhooks")
+SLACK_FAILURES = metrics.Counter("deadbot_slack_failures_total", "Failed Slack posts, by status or error", ("reason",))
+
+# A keep-alive HTTP connection to a single URL, reopened after any error
+class Connection:
+    def __init__(self, url, timeout=15):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.netloc
+        self.path = parts.path + ("?" + parts.query if parts.query else "")
+        self.timeout = timeout
+        self.conn = None
+
+    def post(self, body, headers=None, path=None):
+        if not self.conn:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.conn = cls(self.host, timeout=self.timeout)
+        try:
+            self.conn.request("POST", path or self.path, body=body, headers=headers or {})
+            res = self.conn.getresponse()
+            res.read()
+        except Exception:
+            self.close()
+            raise
+        if res.will_close:
+            self.close()
+        return res
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+# Messages for Slack webhooks, posted in order by one background thread.
+# Messages for the same webhook that queue up while a post is in flight are
+# coalesced into the next one. Webhooks on the same host share a connection.
+class Outbox:
+    def __init__(self, url=None, size=256, interval=1.0, retries=5, backoff=1.0, batch=20):
+        self.url = url
+        self.conns = {}
+        self.queue = queue.Queue(maxsize=size)
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.batch = batch
+        self.last = {}
+        self.thread = None
+        self._start = threading.Lock()
+
+    def put(self, msg : str, url=None):
+        with self._start:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name="slack", daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((url or self.url, msg))
+        except queue.Full:
+            SLACK_FAILURES.inc("dropped")
+            print("Slack queue full, dropping", repr(msg))
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            groups = {}
+            for url, msg in items:
+                groups.setdefault(url, []).append(msg)
+            try:
+                for url, msgs in groups.items():
+                    self.send(url, "\n\n".join(msgs))
+            except Exception:
+                # This is the only thread posting, so it must outlive a bad batch
+                SLACK_FAILURES.inc("error")
+                traceback.print_exc()
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def connection(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        if key not in self.conns:
+            self.conns[key] = Connection(url)
+        return self.conns[key], parts.path + ("?" + parts.query if parts.query else "")
+
+    def send(self, url, text):
+        conn, path = self.connection(url)
+        body = json.dumps({"text": text}).encode("utf-8")
+        delay = self.backoff
+        for attempt in range(self.retries):
+            time.sleep(max(0, self.last.get(url, 0) + self.interval - time.monotonic()))
+            self.last[url] = time.monotonic()
+            try:
+                with SLACK_SECONDS.time():
+                    res = conn.post(body, {"Content-Type": "application/json"}, path=path)
+            except (OSError, http.client.HTTPException) as e:
+                SLACK_FAILURES.inc(type(e).__name__)
+                print("Slack post failed:", e)
+            else:
+                if res.status == 200:
+                    return True
+                SLACK_FAILURES.inc(str(res.status))
+                print("Scary reponse from Slack", res.status, res.reason)
+                if res.status == 429:
+                    delay = max(delay, retry_after(res.getheader("Retry-After")))
+                elif 400 <= res.status < 500:
+                    break
+            # No point waiting after the last attempt; other messages are queued
+            if attempt < self.retries - 1:
+                time.sleep(delay)
+                delay *= 2
+        SLACK_FAILURES.inc("gave up")
+        print("Giving up on Slack message", repr(text))
+        return False
+
+    def drain(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+def retry_after(value):
+    """Seconds to wait from a Retry-After header, in seconds or as an HTTP date"""
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,77 @@
+FORMATS = {
+    "user": "@USER",
+    "date": "YYYY-MM-DD",
+    "time": "HH:MM",
+}
+
+LEAF = object()
+
+# Command patterns compiled into a trie keyed on arity and then on each
+# literal token, with `None` standing for a variable. When several patterns
+# match, the one registered first wins, as in a linear scan.
+#
+# A pattern may end in a variable like ["conf", ...], which takes one or more
+# arguments as a list. Such patterns are keyed on minus their length and
+# tried for every command at least that long.
+class Dispatcher:
+    def __init__(self, slash, formats=FORMATS):
+        self.slash = slash
+        self.formats = formats
+        self.commands = []
+        self.trie = {}
+        self._help = None
+
+    def command(self, *pattern, uid=False, public=False, lock="write", defer=False):
+        def decorator(f):
+            node = self.trie.setdefault(-len(pattern) if rest(pattern) else len(pattern), {})
+            for val in pattern:
+                node = node.setdefault(None if isinstance(val, list) else val, {})
+            node.setdefault(LEAF, len(self.commands))
+            self.commands.append((pattern, { "uid": uid, "public": public, "lock": lock, "defer": defer }, f))
+            self._help = None
+            return f
+        return decorator
+
+    def match(self, args):
+        best = None
+        stack = [(self.trie.get(len(args)), 0, len(args))]
+        stack.extend((node, 0, -n) for n, node in self.trie.items() if -len(args) <= n < 0)
+        while stack:
+            node, i, end = stack.pop()
+            if node is None: continue
+            if i == end:
+                if best is None or node[LEAF] < best: best = node[LEAF]
+                continue
+            stack.append((node.get(args[i]), i + 1, end))
+            stack.append((node.get(None), i + 1, end))
+        if best is None: return None
+        pattern, opts, f = self.commands[best]
+        vars = [arg for val, arg in zip(pattern, args) if isinstance(val, list)]
+        if rest(pattern):
+            vars[-1:] = [args[len(pattern) - 1:]]
+        return opts, f, vars
+
+    def help(self):
+        if self._help is None:
+            private = "I understand the following commands:\n\n"
+            public = "Public announcement commands:\n\n"
+            for pattern, opts, f in self.commands:
+                if not f.__doc__: continue
+                s = "• `" + self.slash + " "
+                for val in pattern:
+                    if isinstance(val, list):
+                        s += self.formats.get(val[0], val[0].upper())
+                        if val[1:] == [...]: s += "..."
+                    else:
+                        s += val
+                    s += " "
+                s += "` — " + str(f.__doc__) + "\n"
+                if opts["public"]:
+                    public += s
+                else:
+                    private += s
+            self._help = private + "\n" + public
+        return self._help
+
+def rest(pattern):
+    return bool(pattern) and isinstance(pattern[-1], list) and pattern[-1][1:] == [...]
@@ -0,0 +1,101 @@
+import time
+import bisect
+import threading
+import contextlib
+
+# Counters, gauges and histograms rendered in the Prometheus text format.
+# Every metric registers itself in REGISTRY when it is created; label values
+# are passed positionally in the order of the metric's `labels`.
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [("", key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, key, value in self.samples():
+            labels = ",".join('{}="{}"'.format(name, escape(val)) for name, val in zip(self.labels + ("le",), key))
+            lines.append("{}{}{} {}".format(self.name, suffix, "{" + labels + "}" if labels else "", float(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *key, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+# A gauge is either set directly or computed on each scrape by `collect`,
+# which returns a dict from label tuples to values.
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, *key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.collect:
+            return [("", key, value) for key, value in self.collect().items()]
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, *key, value):
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *key):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*key, value=time.perf_counter() - start)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        out = []
+        for key, counts in values:
+            total = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                total += n
+                out.append(("_bucket", key + (le,), total))
+            out.append(("_sum", key, counts[-1]))
+            out.append(("_count", key, total))
+        return out
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
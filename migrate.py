@@ -0,0 +1,43 @@
+#!/bin/python3
+
+# Copies a pickled store, snapshot plus journal, into a SQLite database for
+# use with --store sqlite. Run it from the bot's data directory:
+#
+#     python migrate.py deadbot
+#     python migrate.py birthbot
+#     python migrate.py deadbot --root T0123
+
+import os
+import argparse
+import importlib
+
+STORES = {
+    "deadbot": ("Deadlines", "SqliteDeadlines"),
+    "birthbot": ("Birthdays", "SqliteBirthdays"),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bot", choices=sorted(STORES))
+    parser.add_argument("--root", default=".", help="Directory holding the store")
+    args = parser.parse_args()
+
+    old_store, new_store = STORES[args.bot]
+    bot = importlib.import_module(args.bot)
+    old = getattr(bot, old_store)(args.root)
+    new = getattr(bot, new_store)(args.root)
+    if os.path.exists(new.db.path):
+        raise SystemExit("{} already exists; not overwriting it".format(new.db.path))
+    if not old.journal.exists():
+        raise SystemExit("No {} store in {}".format(args.bot, os.path.abspath(args.root)))
+    with old.lock():
+        old.load()
+        with new.lock():
+            new.load()
+            new.migrate(old)
+            new.load()
+            # Everything still live must have made it across
+            missing = {(name, record.when) for name, record in old.all()} - {(name, record.when) for name, record in new.all()}
+    if missing:
+        os.remove(new.db.path)
+        raise SystemExit("Migration lost {} records, such as {}; removed {}".format(len(missing), min(missing), new.db.path))
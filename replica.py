@@ -0,0 +1,373 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+import traceback
+import contextlib
+import collections
+from datetime import datetime, timedelta
+
+import store
+import metrics
+
+PUBLISH_SECONDS = metrics.Histogram("deadbot_publish_seconds", "Time to publish a snapshot for followers", ("store",))
+PUBLISH_BYTES = metrics.Counter("deadbot_publish_bytes_total", "Bytes of snapshots published for followers", ("store",))
+RELOADS = metrics.Counter("deadbot_replica_reloads_total", "Snapshots mapped by a follower")
+
+# Conferences published by the leader for read-only followers, as one file
+# that followers map and query in place instead of unpickling. All numbers
+# are little-endian, and the sections follow the header in this order:
+#
+#   records  (when, name offset, name length, who start, who count) for each
+#            occurrence, sorted by name and then time
+#   order    record numbers sorted by time and then name
+#   users    (uid offset, uid length, mine start, mine count), sorted by uid
+#   who      user numbers; each record's submitters are a run of these
+#   mine     record numbers; each user's submissions are a run, by time
+#   strings  UTF-8 names and uids, which the offsets above point into
+#
+# Times are microseconds since the epoch. A new snapshot is written beside
+# the old one and renamed over it, so a follower maps one or the other.
+
+MAGIC = b"DEADREP1"
+HEADER = struct.Struct("<8sQdIII6I")
+RECORD = struct.Struct("<qIIII")
+USER = struct.Struct("<IIII")
+INDEX = struct.Struct("<I")
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+Conference = collections.namedtuple("Conference", ["when", "who", "announcements"])
+
+class ReadOnly(Exception):
+    pass
+
+def micros(when):
+    return (when - EPOCH) // MICROSECOND
+
+def encode(version, modified, conferences):
+    """The snapshot of (name, when, who) `conferences` as bytes"""
+    confs = sorted((name.encode("utf-8"), when, sorted(uid.encode("utf-8") for uid in who)) for name, when, who in conferences)
+    uids = sorted({uid for _, _, who in confs for uid in who})
+    numbers = {uid: n for n, uid in enumerate(uids)}
+    strings = bytearray()
+    offsets = {}
+    def string(b):
+        if b not in offsets:
+            offsets[b] = len(strings)
+            strings.extend(b)
+        return offsets[b]
+
+    records = bytearray()
+    who = []
+    mine = [[] for _ in uids]
+    for i, (name, when, members) in enumerate(confs):
+        records += RECORD.pack(micros(when), string(name), len(name), len(who), len(members))
+        for uid in members:
+            who.append(numbers[uid])
+            mine[numbers[uid]].append(i)
+    order = sorted(range(len(confs)), key=lambda i: (confs[i][1], confs[i][0]))
+
+    users = bytearray()
+    flat = []
+    for uid, runs in zip(uids, mine):
+        users += USER.pack(string(uid), len(uid), len(flat), len(runs))
+        flat.extend(sorted(runs, key=lambda i: confs[i][1]))
+
+    sections = [bytes(records), index(order), bytes(users), index(who), index(flat), bytes(strings)]
+    starts = []
+    pos = HEADER.size
+    for section in sections:
+        starts.append(pos)
+        pos += len(section)
+    names = len({name for name, _, _ in confs})
+    return b"".join([HEADER.pack(MAGIC, version, modified, len(confs), names, len(uids), *starts)] + sections)
+
+def index(numbers):
+    return struct.pack("<{}I".format(len(numbers)), *numbers)
+
+def write(path, data):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp, path)
+
+# A sequence computed on demand, so bisect can search a mapped section
+class Column:
+    def __init__(self, n, get):
+        self.n = n
+        self.get = get
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+# One mapped snapshot. It stays valid while anyone holds it, even after the
+# leader has replaced the file.
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as fd:
+            self.stat = os.fstat(fd.fileno())
+            self.buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.modified, self.n, self.names, self.users, *starts = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError("{} is not a published snapshot".format(path))
+        self.records, self.order, self.uids, self.who, self.mine, self.strings = starts
+        self.keys = Column(self.n, self.key)
+        self.times = Column(self.n, lambda j: self.record(self.number(self.order, j))[0])
+        self.uid_keys = Column(self.users, lambda n: self.string(*self.user(n)[:2]))
+        # Decoded as they are first needed; there are few users
+        self.uid_names = {}
+
+    def same(self, stat):
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) == (self.stat.st_ino, self.stat.st_mtime_ns, self.stat.st_size)
+
+    def record(self, i):
+        return RECORD.unpack_from(self.buf, self.records + i * RECORD.size)
+
+    def user(self, n):
+        return USER.unpack_from(self.buf, self.uids + n * USER.size)
+
+    def number(self, section, i):
+        return INDEX.unpack_from(self.buf, section + i * INDEX.size)[0]
+
+    def string(self, offset, length):
+        return self.buf[self.strings + offset:self.strings + offset + length]
+
+    def key(self, i):
+        when, name, length, _, _ = self.record(i)
+        return self.string(name, length), when
+
+    def name(self, i):
+        _, name, length, _, _ = self.record(i)
+        return self.string(name, length).decode("utf-8")
+
+    def uid(self, n):
+        uid = self.uid_names.get(n)
+        if uid is None:
+            uid = self.uid_names[n] = self.string(*self.user(n)[:2]).decode("utf-8")
+        return uid
+
+    def conference(self, i):
+        when, _, _, start, count = self.record(i)
+        who = {self.uid(self.number(self.who, start + k)) for k in range(count)}
+        return Conference(EPOCH + when * MICROSECOND, who, [])
+
+    def next(self, name, when):
+        """The record of the first `name` after `when`"""
+        name = name.encode("utf-8")
+        i = bisect.bisect_right(self.keys, (name, micros(when)))
+        if i == self.n or self.key(i)[0] != name:
+            raise KeyError("No conference {}".format(name.decode("utf-8")))
+        return i
+
+    def past(self, name, when):
+        name = name.encode("utf-8")
+        return range(bisect.bisect_left(self.keys, (name,)), bisect.bisect_right(self.keys, (name, micros(when))))
+
+    def after(self, when):
+        start = bisect.bisect_right(self.times, micros(when))
+        return [i for i, in INDEX.iter_unpack(self.buf[self.order + start * INDEX.size:self.order + self.n * INDEX.size])]
+
+    def submissions(self, uid):
+        uid = uid.encode("utf-8")
+        n = bisect.bisect_left(self.uid_keys, uid)
+        if n == self.users or self.uid_keys[n] != uid:
+            return []
+        _, _, start, count = self.user(n)
+        return [self.number(self.mine, start + k) for k in range(count)]
+
+# A follower's read-only view of a leader's Deadlines, answering the same
+# queries from the latest published snapshot. Each read picks up a newer
+# snapshot if the leader has published one and keeps using it until it ends.
+class Replica(store.Versioned):
+    def __init__(self, path, archive=None):
+        self.renders = {}
+        self.path = path
+        self.archive = archive
+        self.snapshot = None
+        self.watchers = []
+        self.loaded = threading.Event()
+        self.local = threading.local()
+        self.reload = threading.Lock()
+
+    def current(self):
+        pinned = getattr(self.local, "snapshot", None)
+        if pinned:
+            return pinned
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise FileNotFoundError("No snapshot at {}; is the leader running with --publish?".format(self.path)) from None
+        if not self.snapshot or not self.snapshot.same(stat):
+            with self.reload:
+                if not self.snapshot or not self.snapshot.same(os.stat(self.path)):
+                    self.snapshot = Snapshot(self.path)
+                    RELOADS.inc()
+        return self.snapshot
+
+    @property
+    def version(self):
+        return self.current().version
+
+    @property
+    def modified(self):
+        return self.current().modified
+
+    @contextlib.contextmanager
+    def read(self):
+        if getattr(self.local, "snapshot", None):
+            yield
+            return
+        self.local.snapshot = self.current()
+        try:
+            yield
+        finally:
+            self.local.snapshot = None
+
+    # Nothing here changes, so writes fail when they try to commit
+    lock = read
+
+    def load(self):
+        print("Loaded", self.summary())
+        self.loaded.set()
+
+    def save(self):
+        pass
+
+    def expire(self):
+        return False
+
+    def dirty(self):
+        return False
+
+    def commit(self, *record):
+        self.commit_many([record])
+
+    def commit_many(self, records):
+        raise ReadOnly("This is a read-only follower")
+
+    def size(self):
+        return self.current().names
+
+    def summary(self):
+        return "data about {} conferences from {}".format(self.size(), self.path)
+
+    def get_conf(self, name, when):
+        snapshot = self.current()
+        return snapshot.conference(snapshot.next(name, when))
+
+    def occurrence(self, name, when):
+        conf = self.get_conf(name, when - MICROSECOND)
+        if conf.when != when: raise KeyError("No conference {} on {}".format(name, when))
+        return conf
+
+    def who(self, name, when):
+        return self.get_conf(name, when).who
+
+    def when(self, name, when):
+        return self.get_conf(name, when).when
+
+    def occurrences(self, name, when):
+        snapshot = self.current()
+        out = []
+        try:
+            i = snapshot.next(name, when)
+        except KeyError:
+            return out
+        name = name.encode("utf-8")
+        while i < snapshot.n and snapshot.key(i)[0] == name:
+            out.append(EPOCH + snapshot.key(i)[1] * MICROSECOND)
+            i += 1
+        return out
+
+    def history(self, name, when):
+        snapshot = self.current()
+        past = {conf.when: conf for archived, conf in (self.archive or ()) if archived == name}
+        for i in snapshot.past(name, when):
+            conf = snapshot.conference(i)
+            past.setdefault(conf.when, conf)
+        return [past[w] for w in sorted(past)]
+
+    def after(self, when):
+        snapshot = self.current()
+        return [(EPOCH + snapshot.record(i)[0] * MICROSECOND, snapshot.name(i)) for i in snapshot.after(when)]
+
+    def upcoming(self, when):
+        snapshot = self.current()
+        out = []
+        seen = set()
+        for i in snapshot.after(when):
+            # Each name is stored once, so its offset identifies it
+            _, name, length, _, _ = snapshot.record(i)
+            if name in seen: continue
+            seen.add(name)
+            out.append((snapshot.string(name, length).decode("utf-8"), snapshot.conference(i)))
+        return out
+
+    def mine(self, uid, when):
+        snapshot = self.current()
+        after = micros(when)
+        return [(snapshot.name(i), snapshot.conference(i)) for i in snapshot.submissions(uid) if snapshot.record(i)[0] > after]
+
+    def all(self):
+        snapshot = self.current()
+        return [(snapshot.name(i), snapshot.conference(i)) for i in range(snapshot.n)]
+
+# Publishes a store for followers once at start, then after each change to
+# its version, expiry included, at most once every `interval` seconds so a
+# burst of commits is one snapshot.
+# The store is only read-locked while its conferences are copied out.
+class Publisher:
+    def __init__(self, data, path, interval=1.0):
+        self.data = data
+        self.path = path
+        self.interval = interval
+        self.pending = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.publish()
+        self.data.listeners.append(self.changed)
+        self.thread = threading.Thread(target=self.run, name="publish", daemon=True)
+        self.thread.start()
+        return self
+
+    def changed(self):
+        self.pending.set()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            if self.stopped: return
+            time.sleep(self.interval)
+            self.pending.clear()
+            try:
+                self.publish()
+            except Exception:
+                traceback.print_exc()
+
+    def publish(self):
+        kind = type(self.data).__name__
+        with PUBLISH_SECONDS.time(kind):
+            with self.data.read():
+                version, modified = self.data.version, self.data.modified
+                conferences = [(name, conf.when, conf.who) for name, conf in self.data.all()]
+            data = encode(version, modified, conferences)
+            write(self.path, data)
+        PUBLISH_BYTES.inc(kind, amount=len(data))
+
+    def stop(self):
+        self.stopped = True
+        self.pending.set()
+        if self.thread:
+            self.thread.join()
+        self.publish()
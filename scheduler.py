@@ -0,0 +1,73 @@
+import time
+import heapq
+import itertools
+import threading
+import traceback
+
+# A timer heap keyed by arbitrary hashable keys. Rescheduling a key just
+# pushes a new entry; entries whose due time no longer matches `pending`
+# are stale and dropped when they reach the top of the heap.
+class Scheduler:
+    def __init__(self, fire):
+        self.fire = fire
+        self.heap = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def schedule(self, key, due):
+        with self.cond:
+            if self.pending.get(key) == due: return
+            self.pending[key] = due
+            heapq.heappush(self.heap, (due, next(self.counter), key))
+            if self.heap[0][2] == key:
+                self.cond.notify()
+
+    def cancel(self, key):
+        with self.cond:
+            self.pending.pop(key, None)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def keys(self):
+        with self.cond:
+            return list(self.pending)
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, key = heapq.heappop(self.heap)
+            if self.pending.get(key) == when:
+                del self.pending[key]
+                due.append(key)
+        return due
+
+    def run(self):
+        with self.cond:
+            while not self.stopped:
+                due = self.pop_due(time.time())
+                if due:
+                    self.cond.release()
+                    try:
+                        self.fire(due)
+                    except Exception:
+                        traceback.print_exc()
+                    finally:
+                        self.cond.acquire()
+                elif self.heap:
+                    self.cond.wait(self.heap[0][0] - time.time())
+                else:
+                    self.cond.wait()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
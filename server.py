@@ -0,0 +1,37 @@
+import http.server
+import concurrent.futures
+
+class PooledHTTPServer(http.server.HTTPServer):
+    # Slack retries after 3 seconds, so a slow client should not hold a worker much longer
+    request_timeout = 5
+    request_queue_size = 64
+
+    def __init__(self, address, handler, workers=8):
+        super().__init__(address, handler)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+def listen(handler, port:int, workers:int = 8):
+    return PooledHTTPServer(("", port), handler, workers=workers)
+
+def serve(handler, port:int, workers:int = 8):
+    httpd = listen(handler, port, workers)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
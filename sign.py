@@ -0,0 +1,100 @@
+#!/bin/python3
+
+import threading
+import http.server
+import http.client
+import urllib.parse
+
+import delivery
+import metrics
+
+SIGN_SECONDS = metrics.Histogram("deadbot_sign_post_seconds", "Latency of posts to the PLSE sign")
+SIGN_FAILURES = metrics.Counter("deadbot_sign_failures_total", "Failed sign posts, by status or error", ("reason",))
+
+URL = "http://plseaudio.cs.washington.edu:8087"
+
+# The PLSE sign shows one thing at a time, so only the most recent request
+# matters. Requests are posted by a background thread over one persistent
+# connection; a newer request replaces a pending one, and a request equal
+# to the one being sent is folded into it. Anything else is sent, even if
+# the sign showed it before, since the sign may have changed since.
+class Sign:
+    def __init__(self, url=URL, retries=5, backoff=1.0):
+        self.conn = delivery.Connection(url)
+        self.retries = retries
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        self.pending = None
+        self.sending = None
+        self.thread = None
+
+    def show(self, conf, when):
+        self.put(("/deadline", urllib.parse.urlencode({ 'what': conf, 'when': '{:%Y-%m-%d %H:%M:%S GMT-0000}'.format(when) })))
+
+    def restore(self):
+        self.put(("/restore_clock", ""))
+
+    def put(self, req):
+        with self.cond:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name="sign", daemon=True)
+                self.thread.start()
+            self.pending = None if req == self.sending else req
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                req, self.pending = self.pending, None
+                self.sending = req
+            try:
+                self.send(req)
+            finally:
+                with self.cond:
+                    self.sending = None
+
+    def send(self, req):
+        path, data = req
+        delay = self.backoff
+        for attempt in range(self.retries):
+            try:
+                with SIGN_SECONDS.time():
+                    res = self.conn.post(data.encode("utf-8"), {"Content-Type": "application/x-www-form-urlencoded"}, path=path)
+            except (OSError, http.client.HTTPException) as e:
+                SIGN_FAILURES.inc(type(e).__name__)
+                print("PLSE Sign post failed:", e)
+            else:
+                if res.status == 200:
+                    return True
+                SIGN_FAILURES.inc(str(res.status))
+                print("Scary reponse from PLSE Sign", res.status, res.reason)
+            with self.cond:
+                if self.cond.wait_for(lambda: self.pending, delay):
+                    return False
+            delay *= 2
+        SIGN_FAILURES.inc("gave up")
+        print("Giving up on PLSE Sign request", path, data)
+        return False
+
+class StubSignHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"] or 0)
+        data = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+        if self.path not in ["/deadline", "/restore_clock"]:
+            self.send_response(404)
+        else:
+            print("Sign:", self.path, {k: v[0] for k, v in data.items()})
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the PLSE sign")
+    parser.add_argument("--port", type=int, default=8087)
+    args = parser.parse_args()
+    http.server.HTTPServer(("", args.port), StubSignHandler).serve_forever()
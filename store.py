@@ -0,0 +1,409 @@
+import os
+import sys
+import time
+import pickle
+import datetime
+import threading
+import contextlib
+
+import metrics
+
+LOCK_WAIT = metrics.Histogram("deadbot_lock_wait_seconds", "Time spent waiting for a store lock", ("store", "mode"))
+SAVE_SECONDS = metrics.Histogram("deadbot_save_seconds", "Duration of Store.save()", ("store",))
+SAVE_BYTES = metrics.Counter("deadbot_save_bytes_total", "Bytes written by snapshots", ("store",))
+RENDERS = metrics.Counter("deadbot_renders_total", "Cached renderings of a store, reused or recomputed", ("store", "result"))
+
+# Bots once ran as scripts, so older files pickled their classes as
+# __main__.*; those are looked up in the store's own `module` instead.
+class Unpickler(pickle.Unpickler):
+    def __init__(self, fd, module=None):
+        super().__init__(fd)
+        self.module = module
+
+    def find_class(self, module, name):
+        if module == "__main__" and self.module:
+            module = self.module
+        return super().find_class(module, name)
+
+# An append-only log of mutations on top of a pickled snapshot. The snapshot
+# ends with the sequence number of the last record folded into it, so records
+# left over from a crash mid-compaction are not replayed twice.
+class Journal:
+    def __init__(self, snapshot, journal, module=None, sync_every=32, sync_interval=5, compact_every=1000):
+        self.snapshot = snapshot
+        self.path = journal
+        self.module = module
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.records = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.fd = None
+        # Records left unsynced by a quiet spell are synced by a timer
+        self.timer = None
+        self.mutex = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.snapshot) or os.path.exists(self.path)
+
+    def load(self, default):
+        if not os.path.exists(self.snapshot):
+            return default
+        with open(self.snapshot, "rb") as fd:
+            state = Unpickler(fd, self.module).load()
+            try:
+                self.seq = Unpickler(fd, self.module).load()
+            except EOFError:
+                self.seq = 0
+        return state
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as fd:
+            while True:
+                pos = fd.tell()
+                try:
+                    seq, record = Unpickler(fd, self.module).load()
+                except EOFError:
+                    break
+                except Exception:
+                    print("Truncating torn journal record at byte", pos)
+                    fd.truncate(pos)
+                    break
+                if seq <= self.seq: continue
+                self.seq = seq
+                self.records += 1
+                yield record
+
+    def append(self, record):
+        self.extend([record])
+
+    # Records written together go out in one write and, if due, one fsync
+    def extend(self, records):
+        out = []
+        for record in records:
+            self.seq += 1
+            out.append(pickle.dumps((self.seq, record)))
+        with self.mutex:
+            if not self.fd:
+                self.fd = open(self.path, "ab")
+            self.fd.write(b"".join(out))
+            self.fd.flush()
+            self.records += len(out)
+            self.unsynced += len(out)
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+            elif not self.timer:
+                self.timer = threading.Timer(self.sync_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def sync(self):
+        with self.mutex:
+            self._sync()
+
+    def _sync(self):
+        if self.fd and self.unsynced:
+            os.fsync(self.fd.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def full(self):
+        return self.records >= self.compact_every
+
+    def compact(self, state):
+        tmp = self.snapshot + ".tmp"
+        with open(tmp, "wb") as fd:
+            pickle.dump(state, fd)
+            pickle.dump(self.seq, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+            size = fd.tell()
+        os.replace(tmp, self.snapshot)
+        with self.mutex:
+            if self.fd:
+                self.fd.close()
+            self.fd = open(self.path, "wb")
+            self.records = 0
+            self.unsynced = 0
+            self._sync()
+        return size
+
+# Records that no longer change, appended as they expire from a Store and
+# only read back when someone asks for history. A record torn by a crash
+# ends the archive; a record written twice is up to the reader to drop.
+class Archive:
+    def __init__(self, path, module=None):
+        self.path = path
+        self.module = module
+
+    def extend(self, records):
+        with open(self.path, "ab") as fd:
+            for record in records:
+                pickle.dump(record, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as fd:
+            while True:
+                pos = fd.tell()
+                try:
+                    record = Unpickler(fd, self.module).load()
+                except EOFError:
+                    return
+                except Exception:
+                    print("Ignoring torn archive record at byte", pos)
+                    return
+                yield record
+
+# Each distinct user id stored once and numbered, so a group of users is an
+# int with one bit per member instead of a set of strings.
+class Users:
+    def __init__(self, uids=()):
+        self.uids = [sys.intern(uid) for uid in uids]
+        self.ids = {uid: i for i, uid in enumerate(self.uids)}
+
+    def id(self, uid):
+        i = self.ids.get(uid)
+        if i is None:
+            i = self.ids[uid] = len(self.uids)
+            self.uids.append(sys.intern(uid))
+        return i
+
+    def bits(self, uids):
+        out = 0
+        for uid in uids:
+            out |= 1 << self.id(uid)
+        return out
+
+    def members(self, bits):
+        out = set()
+        while bits:
+            low = bits & -bits
+            out.add(self.uids[low.bit_length() - 1])
+            bits ^= low
+        return out
+
+# Many readers or one writer. Waiting writers block new readers so a steady
+# stream of reads cannot starve mutations.
+class RWLock:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+    def held(self):
+        return self.writer or self.readers > 0
+
+# `version` goes up with every change, and `modified` is when it last did,
+# so text rendered from a store can be kept until it changes. Versions start
+# over when a store loads, so renderings are keyed by both, as ETags are.
+# Expired state is never part of such text.
+class Versioned:
+    def __init__(self):
+        self.version = 0
+        self.modified = time.time()
+        self.renders = {}
+        # Called with no arguments after every change, including expiry,
+        # which watchers of individual records never see
+        self.listeners = []
+
+    def changed(self):
+        self.version += 1
+        self.modified = time.time()
+        for listen in self.listeners:
+            listen()
+
+    # `render` returns some text and the time at which it goes stale even if
+    # the store does not change; call with at least a read lock held
+    def cached(self, name, now, render):
+        version = (self.version, self.modified)
+        hit = self.renders.get(name)
+        if hit and hit[0] == version and now < hit[1]:
+            RENDERS.inc(type(self).__name__, "hit")
+            return hit[2]
+        RENDERS.inc(type(self).__name__, "miss")
+        text, stale = render()
+        self.renders[name] = (version, stale, text)
+        return text
+
+# A store kept in memory and persisted as a Journal. Subclasses hold their
+# state however suits their queries; they provide `apply` for journal records,
+# `snapshot`/`restore` to convert to and from the pickled state, `size` and
+# a `summary` for the log. Before each snapshot `expire` may drop state that
+# can no longer matter, returning True if it dropped anything.
+class Store(Versioned):
+    def __init__(self, snapshot, journal):
+        super().__init__()
+        self._lock = RWLock()
+        self.journal = Journal(snapshot, journal, type(self).__module__)
+        self.watchers = []
+        self.loaded = threading.Event()
+
+    @contextlib.contextmanager
+    def lock(self):
+        start = time.perf_counter()
+        with self._lock.write():
+            LOCK_WAIT.observe(type(self).__name__, "write", value=time.perf_counter() - start)
+            yield
+
+    @contextlib.contextmanager
+    def read(self):
+        start = time.perf_counter()
+        with self._lock.read():
+            LOCK_WAIT.observe(type(self).__name__, "read", value=time.perf_counter() - start)
+            yield
+
+    def unlocked(self):
+        return not self._lock.held()
+
+    def save(self):
+        with SAVE_SECONDS.time(type(self).__name__):
+            if self.expire():
+                self.changed()
+            size = self.journal.compact(self.snapshot())
+        SAVE_BYTES.inc(type(self).__name__, amount=size)
+
+    def expire(self):
+        return False
+
+    def load(self):
+        if self.journal.exists():
+            self.restore(self.journal.load({}))
+            for record in self.journal.replay():
+                self.apply(*record)
+            print("Loaded", self.summary())
+        self.changed()
+        self.loaded.set()
+
+    def dirty(self):
+        return self.journal.records > 0
+
+    def commit(self, *record):
+        self.commit_many([record])
+
+    # A record that fails to apply stops the batch; the ones before it stay
+    # applied and are journaled, so memory and disk agree
+    def commit_many(self, records):
+        applied = []
+        try:
+            for record in records:
+                self.apply(*record)
+                applied.append(record)
+        finally:
+            if applied:
+                self.changed()
+                self.journal.extend(applied)
+                if self.journal.full():
+                    self.save()
+        for record in applied:
+            for watch in self.watchers:
+                watch(*record)
+
+# A SQLite database in WAL mode with one connection per thread, so readers
+# holding the shared side of an RWLock do not contend on a connection.
+class Database:
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    def create(self):
+        with self.connect() as conn:
+            conn.executescript(self.schema)
+
+    def execute(self, sql, args=()):
+        return self.connect().execute(sql, args)
+
+    def executemany(self, sql, rows):
+        return self.connect().executemany(sql, rows)
+
+    def transaction(self):
+        return self.connect()
+
+    def checkpoint(self):
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+# Mixed in ahead of a Store subclass whose state lives in `self.db`, a
+# Database; each commit is its own transaction, so there is nothing to save.
+class SqliteStore:
+    def save(self):
+        with SAVE_SECONDS.time(type(self).__name__):
+            self.expire()
+            self.db.checkpoint()
+
+    def load(self):
+        self.db.create()
+        print("Loaded", self.summary())
+        self.changed()
+        self.loaded.set()
+
+    def dirty(self):
+        return False
+
+    def commit(self, *record):
+        self.commit_many([record])
+
+    def commit_many(self, records):
+        try:
+            with self.db.transaction():
+                for record in records:
+                    self.apply(*record)
+        finally:
+            self.changed()
+        for record in records:
+            for watch in self.watchers:
+                watch(*record)
+
+def sqltime(when):
+    return when.isoformat(" ", "microseconds") if isinstance(when, datetime.datetime) else when.isoformat()